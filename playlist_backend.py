@@ -1,7 +1,30 @@
 import pandas as pd
 import numpy as np
 import re
+import os
+import json
+import hashlib
+import time
+import threading
+import queue
+import uuid
+import sqlite3
+from datetime import datetime, timezone
+from collections import OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, wait
+try:
+    import fcntl                 # file locks for the rating reference (POSIX only)
+except ImportError:
+    fcntl = None
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pyarrow.dataset as ds
 from joblib import load
+import xgboost as xgb
 import streamlit as st
 
 
@@ -20,17 +43,129 @@ SPOTIPY_REDIRECT_URI = st.secrets["SPOTIPY_REDIRECT_URI"]
 
 SCOPE = "playlist-read-private playlist-read-collaborative"
 
-sp = spotipy.Spotify(
-    auth_manager=SpotifyOAuth(
-        client_id=SPOTIPY_CLIENT_ID,
-        client_secret=SPOTIPY_CLIENT_SECRET,
-        redirect_uri=SPOTIPY_REDIRECT_URI,
-        scope=SCOPE,
-        show_dialog=True,
-        open_browser=True,
-    )
+# How many ratings can talk to Spotify at the same time (one pooled client
+# each) and how many keep-alive connections each client's session holds.
+SPOTIFY_POOL_SIZE = int(st.secrets.get("SPOTIFY_POOL_SIZE", 8))
+SPOTIFY_CONNECTIONS_PER_CLIENT = int(st.secrets.get("SPOTIFY_CONNECTIONS_PER_CLIENT", 4))
+SPOTIFY_CHECKOUT_TIMEOUT = 30  # seconds to wait for a free client
+
+
+class LockedSpotifyOAuth(SpotifyOAuth):
+    """
+    SpotifyOAuth shared by every pooled client. Token reads / refreshes go
+    through one lock so concurrent ratings reuse the same cached token
+    instead of racing to refresh it and rewrite .cache.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._token_lock = threading.Lock()
+
+    def get_access_token(self, *args, **kwargs):
+        with self._token_lock:
+            return super().get_access_token(*args, **kwargs)
+
+
+auth_manager = LockedSpotifyOAuth(
+    client_id=SPOTIPY_CLIENT_ID,
+    client_secret=SPOTIPY_CLIENT_SECRET,
+    redirect_uri=SPOTIPY_REDIRECT_URI,
+    scope=SCOPE,
+    show_dialog=True,
+    open_browser=True,
 )
 
+
+def _build_spotify_session(pool_maxsize: int) -> requests.Session:
+    """
+    Keep-alive HTTP session for one client. Same retry policy spotipy
+    builds by default, with the connection pool sized explicitly.
+    """
+    session = requests.Session()
+    retry = Retry(
+        total=3,
+        connect=None,
+        read=False,
+        allowed_methods=frozenset(["GET", "POST", "PUT", "DELETE"]),
+        status=3,
+        backoff_factor=0.3,
+        status_forcelist=spotipy.Spotify.default_retry_codes,
+    )
+    adapter = HTTPAdapter(
+        pool_connections=1, pool_maxsize=pool_maxsize, max_retries=retry
+    )
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def make_spotify_client() -> spotipy.Spotify:
+    return spotipy.Spotify(
+        auth_manager=auth_manager,
+        requests_session=_build_spotify_session(SPOTIFY_CONNECTIONS_PER_CLIENT),
+    )
+
+
+_spotify_pool = queue.Queue()
+for _ in range(SPOTIFY_POOL_SIZE):
+    _spotify_pool.put(make_spotify_client())
+
+# A client stays checked out while batches a rating gave up waiting for are
+# still running on it (see _run_batches); the last one puts it back.
+_client_lock = threading.Lock()
+_client_pending = {}            # client -> batches still running on it
+_client_returned = set()        # clients whose rating is done, waiting on those
+
+
+def _hold_client(client, n=1):
+    with _client_lock:
+        _client_pending[client] = _client_pending.get(client, 0) + n
+
+
+def _release_client(client):
+    with _client_lock:
+        _client_pending[client] -= 1
+        if _client_pending[client] > 0:
+            return
+        del _client_pending[client]
+        if client not in _client_returned:
+            return
+        _client_returned.discard(client)
+    _spotify_pool.put(client)
+
+
+def _return_client(client):
+    with _client_lock:
+        if _client_pending.get(client):
+            _client_returned.add(client)
+            return
+    _spotify_pool.put(client)
+
+
+@contextmanager
+def spotify_client(timeout: float = SPOTIFY_CHECKOUT_TIMEOUT):
+    """
+    Check a client out of the pool for one request:
+
+        with spotify_client() as sp_client:
+            rate_playlist(url, sp_client, ...)
+
+    Blocks up to `timeout` seconds if every client is busy. A client with
+    fetches still running in the background goes back once they finish.
+    """
+    try:
+        client = _spotify_pool.get(timeout=timeout)
+    except queue.Empty:
+        raise RuntimeError("All Spotify clients are busy, please try again in a moment.")
+    try:
+        yield client
+    finally:
+        _return_client(client)
+
+
+# Stand-alone client for notebooks / scripts (not part of the pool)
+sp = make_spotify_client()
+
 # ----------------------------------------------------------
 # 2) TRAINED MODEL
 # ----------------------------------------------------------
@@ -46,21 +181,84 @@ best_threshold_full = 0.871
 # ----------------------------------------------------------
 # Required functions:
 #extract_playlist_id()
+#iter_playlist_items()
 #load_playlist_tracks()
+#iter_playlist_track_chunks()
 #fetch_audio_features()
 #fetch_artist_info()
 #follower_bucket()
 #genres_to_flags()
 #tempo_bucket_code_func()
-#enrich_playlist_for_model()
 #extract_year()
+#register_feature()
+#plan_features()
+#enrich_playlist_for_model()
+
+#pick_album_image()
+#get_thumbnail()
+
+#model_version()
+#explain_tracks()
+#top_contributions()
+
+#rate_playlist_cached()
+#start_warmup()
+#warmup_status()
+
+#record_playlist_index()
+#reference_moments()
+#playlist_percentile()
+
+#playlist_embedding_from_scored()
+#record_playlist_embedding()
+#build_embedding_index()
+#nearest_playlists()
+
+#write_scored_tracks()
+#finish_scored_tracks()
+#write_rating_summary()
+#query_results()
+#query_summaries()
+#playlist_rating_history()
+#top_artists()
+#compact_results_store()
 
 #label_from_score()
+#summarize_scores()
 #summarize_playlist()
+#score_tracks()
+#top_bottom_tracks()
+#results_table()
 #rate_playlist()
 #
 # full function definitions below:
 
+# --- latency budget ---
+# rate_playlist(deadline=...) makes one budget dict and passes it down to
+# the paging and fetch steps. Each step stops waiting at its cutoff and
+# writes down what it had to leave out, so the summary can report it.
+
+DEADLINE_PAGING_SHARE = 0.6   # stop paging the playlist after 60% of the budget
+DEADLINE_SCORE_SHARE = 0.1    # keep the last 10% for feature steps + predict
+
+
+def make_budget(seconds: float) -> dict:
+    start = time.monotonic()
+    return {
+        "seconds": seconds,
+        "paging_until": start + DEADLINE_PAGING_SHARE * seconds,
+        "fetch_until": start + (1 - DEADLINE_SCORE_SHARE) * seconds,
+        "truncated": False,          # stopped paging before the end
+        "tracks_total": None,        # playlist size reported by Spotify
+        "audio_timed_out": [],       # track ids without audio features
+        "artist_timed_out": [],      # artist ids without artist info
+    }
+
+
+def _seconds_left(budget, key):
+    return None if budget is None else budget[key] - time.monotonic()
+
+
 # --- load_playlist_tracks() ---
 
 def extract_playlist_id(playlist_ref: str) -> str:
@@ -77,14 +275,16 @@ def extract_playlist_id(playlist_ref: str) -> str:
     return playlist_ref
 
 
-def load_playlist_tracks(playlist_ref: str, sp_client, cache_buster=None) -> pd.DataFrame:
+def iter_playlist_items(playlist_ref: str, sp_client, budget=None):
     """
-    Pull all tracks from a playlist and basic track/artist metadata.
-    Returns df with columns: track_id, track_name, artist_name, artist_id, album_release_date, album_image_url.
+    Page through a playlist and yield one track row (dict) at a time with
+    keys: track_id, track_name, artist_name, artist_id, album_release_date,
+    album_image_url (largest cover), album_images (all sizes, smallest first).
+    With a budget, stops requesting pages once its paging time is used up
+    (the first page is always fetched) and sets budget["truncated"].
     """
     playlist_id = extract_playlist_id(playlist_ref)
 
-    items = []
     limit = 100
     offset = 0
 
@@ -96,6 +296,8 @@ def load_playlist_tracks(playlist_ref: str, sp_client, cache_buster=None) -> pd.
             offset=offset
         )
         batch = results.get("items", [])
+        if budget is not None:
+            budget["tracks_total"] = results.get("total")
         if not batch:
             break
 
@@ -118,52 +320,127 @@ def load_playlist_tracks(playlist_ref: str, sp_client, cache_buster=None) -> pd.
             album = track.get("album", {})
             release_date = album.get("release_date")
 
-            # album cover URL (take first image if present)
-            images = album.get("images", [])
+            # album cover URL (take first image if present -- Spotify lists
+            # the largest first) + every size variant, smallest first
+            images = album.get("images") or []
             album_image_url = images[0]["url"] if images else None
-
-            items.append(
-                {
-                    "track_id": tid,
-                    "track_name": tname,
-                    "artist_id": aid,
-                    "artist_name": aname,
-                    "album_release_date": release_date,
-                    "album_image_url": album_image_url, 
-                }
+            album_images = sorted(
+                (
+                    {"url": img["url"], "width": img.get("width"), "height": img.get("height")}
+                    for img in images
+                    if img.get("url")
+                ),
+                key=lambda img: img["width"] or 0,
             )
 
+            yield {
+                "track_id": tid,
+                "track_name": tname,
+                "artist_id": aid,
+                "artist_name": aname,
+                "album_release_date": release_date,
+                "album_image_url": album_image_url,
+                "album_images": album_images,
+            }
+
         if results.get("next") is None:
             break
 
+        if budget is not None and _seconds_left(budget, "paging_until") <= 0:
+            budget["truncated"] = True
+            break
+
         offset += limit
 
-    df = pd.DataFrame(items)
+
+def load_playlist_tracks(playlist_ref: str, sp_client, cache_buster=None, budget=None) -> pd.DataFrame:
+    """
+    Pull all tracks from a playlist and basic track/artist metadata.
+    Returns df with columns: track_id, track_name, artist_name, artist_id, album_release_date,
+    album_image_url, album_images.
+    """
+    df = pd.DataFrame(list(iter_playlist_items(playlist_ref, sp_client, budget=budget)))
     print(f"Loaded {len(df)} playlist tracks (with ids).")
     return df
 
+
+def iter_playlist_track_chunks(playlist_ref: str, sp_client, chunk_size: int = 500, budget=None):
+    """
+    Same rows as load_playlist_tracks(), but yielded as DataFrames of at
+    most chunk_size tracks so the whole playlist is never held at once.
+    """
+    rows = []
+    n_loaded = 0
+    for row in iter_playlist_items(playlist_ref, sp_client, budget=budget):
+        rows.append(row)
+        if len(rows) >= chunk_size:
+            n_loaded += len(rows)
+            yield pd.DataFrame(rows)
+            rows = []
+    if rows:
+        n_loaded += len(rows)
+        yield pd.DataFrame(rows)
+    print(f"Loaded {n_loaded} playlist tracks (with ids) in chunks of {chunk_size}.")
+
 # --- artist info
 
-def fetch_audio_features(track_ids, sp_client) -> pd.DataFrame:
+def _run_batches(batch_func, batches, budget, sp_client, finish_late=False):
+    """
+    Run batch_func over batches. Without a budget: one after the other.
+    With one: in parallel on a small pool of this rating's own (one thread
+    per free connection of sp_client), waiting until budget["fetch_until"].
+    Late batches that haven't started are cancelled unless finish_late; the
+    ones already running keep sp_client checked out until they're done.
+    Returns (results of finished batches, batches that didn't finish).
+    """
+    if budget is None or not batches:
+        return [batch_func(batch) for batch in batches], []
+
+    with _client_lock:
+        busy = _client_pending.get(sp_client, 0)
+    executor = ThreadPoolExecutor(
+        max_workers=max(1, min(SPOTIFY_CONNECTIONS_PER_CLIENT - busy, len(batches))),
+        thread_name_prefix="spotify-fetch",
+    )
+    futures = {executor.submit(batch_func, batch): batch for batch in batches}
+    done, not_done = wait(futures, timeout=max(0.0, _seconds_left(budget, "fetch_until")))
+    executor.shutdown(wait=False, cancel_futures=not finish_late)
+    if not_done:
+        _hold_client(sp_client, len(not_done))
+        for f in not_done:
+            f.add_done_callback(lambda _f: _release_client(sp_client))
+    # done futures are read in submission order so the result is deterministic
+    results = [f.result() for f in futures if f in done]
+    return results, [futures[f] for f in futures if f in not_done]
+
+
+def _fetch_audio_batch(batch, sp_client):
+    feats = sp_client.audio_features(batch)
+    return [af for af in feats if af is not None]
+
+
+def fetch_audio_features(track_ids, sp_client, budget=None) -> pd.DataFrame:
     """
     Batch-fetch audio features for a list of track IDs.
 
     NOTE (2025): Spotify closed its API sadly: Spotify's /v1/audio-features endpoint now returns 403
     for many apps (deprecated / restricted). If that happens, we just
     return an empty DataFrame and continue without audio features.
+
+    With a budget, batches that aren't back in time are dropped (their
+    track ids go to budget["audio_timed_out"]).
     """
     track_ids = [tid for tid in track_ids if tid is not None]
+    batches = [track_ids[i:i+100] for i in range(0, len(track_ids), 100)]
 
-    audio_rows = []
     try:
-        for i in range(0, len(track_ids), 100):
-            batch = track_ids[i:i+100]
-            feats = sp_client.audio_features(batch)
-            for af in feats:
-                if af is None:
-                    continue
-                audio_rows.append(af)
+        results, late = _run_batches(
+            lambda batch: _fetch_audio_batch(batch, sp_client), batches, budget, sp_client
+        )
+        for batch in late:
+            budget["audio_timed_out"].extend(batch)
 
+        audio_rows = [af for rows in results for af in rows]
         df_audio = pd.DataFrame(audio_rows)
         return df_audio
 
@@ -174,27 +451,72 @@ def fetch_audio_features(track_ids, sp_client) -> pd.DataFrame:
         # Return empty DF so downstream code can handle missing columns
         return pd.DataFrame()
 
-def fetch_artist_info(artist_ids, sp_client) -> pd.DataFrame:
+# Artist info barely moves day to day, so rows are kept per artist_id and
+# shared by every rating (and filled ahead of time by the warm-up).
+ARTIST_CACHE_MAX = 100_000
+ARTIST_CACHE_TTL = 24 * 60 * 60  # seconds
+
+_artist_lock = threading.Lock()
+_artist_cache = OrderedDict()   # artist_id -> (fetched_at, row dict)
+
+
+def _fetch_artist_batch(batch, sp_client):
+    """Fetch up to 50 artists and put them in the artist cache."""
+    arts = sp_client.artists(batch)["artists"]
+    fetched = []
+    for art in arts:
+        if art is None:
+            continue
+        fetched.append(
+            {
+                "artist_id": art["id"],
+                "artist_popularity_raw": art.get("popularity", 0),
+                "artist_followers_raw": art.get("followers", {}).get("total", 0),
+                "artist_genres_raw": art.get("genres", []),
+            }
+        )
+
+    now = time.time()
+    with _artist_lock:
+        for row in fetched:
+            _artist_cache[row["artist_id"]] = (now, row)
+            _artist_cache.move_to_end(row["artist_id"])
+        while len(_artist_cache) > ARTIST_CACHE_MAX:
+            _artist_cache.popitem(last=False)
+    return fetched
+
+
+def fetch_artist_info(artist_ids, sp_client, budget=None) -> pd.DataFrame:
     """
     Batch-fetch artist popularity, followers, and genres.
+    Artists already in the artist cache aren't fetched again.
+    With a budget, artists that aren't back in time are left out (ids go to
+    budget["artist_timed_out"]) and their batches finish in the background.
     """
     artist_rows = []
     artist_ids = list({aid for aid in artist_ids if aid is not None})
 
-    for i in range(0, len(artist_ids), 50):
-        batch = artist_ids[i:i+50]
-        arts = sp_client.artists(batch)["artists"]
-        for art in arts:
-            if art is None:
-                continue
-            artist_rows.append(
-                {
-                    "artist_id": art["id"],
-                    "artist_popularity_raw": art.get("popularity", 0),
-                    "artist_followers_raw": art.get("followers", {}).get("total", 0),
-                    "artist_genres_raw": art.get("genres", []),
-                }
-            )
+    now = time.time()
+    to_fetch = []
+    with _artist_lock:
+        for aid in artist_ids:
+            cached = _artist_cache.get(aid)
+            if cached is not None and now - cached[0] < ARTIST_CACHE_TTL:
+                _artist_cache.move_to_end(aid)
+                artist_rows.append(cached[1])
+            else:
+                to_fetch.append(aid)
+
+    batches = [to_fetch[i:i+50] for i in range(0, len(to_fetch), 50)]
+    # late artist batches still fill the artist cache for the next rating
+    results, late = _run_batches(
+        lambda batch: _fetch_artist_batch(batch, sp_client), batches, budget, sp_client,
+        finish_late=True,
+    )
+    for rows in results:
+        artist_rows.extend(rows)
+    for batch in late:
+        budget["artist_timed_out"].extend(batch)
 
     df_art = pd.DataFrame(artist_rows)
     return df_art
@@ -258,82 +580,245 @@ def tempo_bucket_code_func(t):
     return 3              # fast
 
 
-def enrich_playlist_for_model(df_playlist_meta, sp_client) -> pd.DataFrame:
-    # 1) audio features (may fail / be empty)
-    df_audio = fetch_audio_features(df_playlist_meta["track_id"].tolist(), sp_client)
+def extract_year(date_str):
+    try:
+        return int(str(date_str)[:4])
+    except (TypeError, ValueError):
+        return np.nan
 
-    # 2) artist info
-    df_art = fetch_artist_info(df_playlist_meta["artist_id"].tolist(), sp_client)
 
-    # 3) start from playlist meta
-    df = df_playlist_meta.copy()
+# ----------------------------------------------------------
+# 5) FEATURE REGISTRY
+# ----------------------------------------------------------
+# Every engineered column is registered with the columns it is built from.
+# plan_features() walks those inputs backwards from whatever the model asks
+# for, so enrich_playlist_for_model() only computes (and only fetches) what
+# the active model actually uses.
+
+# Columns that come straight out of load_playlist_tracks()
+META_COLS = [
+    "track_id",
+    "track_name",
+    "artist_id",
+    "artist_name",
+    "album_release_date",
+    "album_image_url",
+    "album_images",
+]
+
+# Columns that come from fetch_audio_features()
+AUDIO_COLS = [
+    "danceability",
+    "energy",
+    "key",
+    "loudness",
+    "mode",
+    "speechiness",
+    "acousticness",
+    "instrumentalness",
+    "liveness",
+    "valence",
+    "tempo",
+    "duration_ms",
+    "time_signature",
+]
+
+# Columns that come from fetch_artist_info()
+ARTIST_RAW_COLS = [
+    "artist_popularity_raw",
+    "artist_followers_raw",
+    "artist_genres_raw",
+]
+
+FEATURE_SOURCES = {
+    **{col: "meta" for col in META_COLS},
+    **{col: "audio" for col in AUDIO_COLS},
+    **{col: "artist" for col in ARTIST_RAW_COLS},
+}
+
+FOLLOWER_BUCKETS = ["tiny", "small", "medium", "big", "star"]
+
+GENRE_FLAG_COLS = list(genres_to_flags([]).keys())
+
+FEATURE_REGISTRY = []
+
+
+def register_feature(outputs, inputs, func):
+    """
+    Register a feature step.
+      outputs: column name(s) the step produces
+      inputs:  columns it reads (raw source columns or other features)
+      func:    df -> Series (single output) or DataFrame (one column per output)
+    """
+    if isinstance(outputs, str):
+        outputs = [outputs]
+    FEATURE_REGISTRY.append(
+        {"outputs": list(outputs), "inputs": list(inputs), "func": func}
+    )
 
-    # Merge audio features if available
-    if not df_audio.empty:
-        df = df.merge(df_audio, left_on="track_id", right_on="id", how="left")
-
-    # Merge artist info
-    df = df.merge(df_art, on="artist_id", how="left")
-
-    # ensure raw audio feature columns exist even if audio-features failed ---
-    audio_cols = [
-        "energy",
-        "valence",
-        "danceability",
-        "loudness",
-        "speechiness",
-        "acousticness",
-        "instrumentalness",
-        "tempo",
-        "duration_ms",
-    ]
-    for col in audio_cols:
-        if col not in df.columns:
-            df[col] = np.nan
 
-    # 4) basic fields: year / decade
-    def extract_year(date_str):
-        try:
-            return int(str(date_str)[:4])
-        except:
-            return np.nan
+def _followers_onehot(df):
+    buckets = df["artist_followers"].apply(follower_bucket)
+    onehot = pd.DataFrame({"followers_bucket": buckets}, index=df.index)
+    for bucket in FOLLOWER_BUCKETS:
+        onehot[f"followers_{bucket}"] = (buckets == bucket).astype(int)
+    return onehot
 
-    df["year"] = df["album_release_date"].apply(extract_year)
-    df["decade"] = (df["year"] // 10) * 10
 
-    # 5) fame features
-    df["artist_popularity"] = df["artist_popularity_raw"].fillna(0).astype(float)
-    df["artist_followers"] = df["artist_followers_raw"].fillna(0).astype(float)
-    df["artist_followers_log"] = np.log1p(df["artist_followers"].clip(lower=0))
+def _genre_flags(df):
+    return df["artist_genres_raw"].apply(genres_to_flags).apply(pd.Series)
 
-    df["followers_bucket"] = df["artist_followers"].apply(follower_bucket)
-    for bucket in ["tiny", "small", "medium", "big", "star"]:
-        df[f"followers_{bucket}"] = (df["followers_bucket"] == bucket).astype(int)
 
-    # 6) genres flags
-    genre_flags = df["artist_genres_raw"].apply(genres_to_flags).apply(pd.Series)
-    df = pd.concat([df, genre_flags], axis=1)
+# basic fields: year / decade
+register_feature("year", ["album_release_date"],
+                 lambda df: df["album_release_date"].apply(extract_year))
+register_feature("decade", ["year"], lambda df: (df["year"] // 10) * 10)
 
-    # 7) simple "is_cover" placeholder: assume 0 (original)
-    df["is_cover"] = 0
+# fame features
+register_feature("artist_popularity", ["artist_popularity_raw"],
+                 lambda df: df["artist_popularity_raw"].fillna(0).astype(float))
+register_feature("artist_followers", ["artist_followers_raw"],
+                 lambda df: df["artist_followers_raw"].fillna(0).astype(float))
+register_feature("artist_followers_log", ["artist_followers"],
+                 lambda df: np.log1p(df["artist_followers"].clip(lower=0)))
+register_feature(
+    ["followers_bucket"] + [f"followers_{b}" for b in FOLLOWER_BUCKETS],
+    ["artist_followers"],
+    _followers_onehot,
+)
 
-    # 8) engineered features
-    # These will just be NaN if the base audio features are NaN
-    df["energy_valence"] = df["energy"] * df["valence"]
-    df["dance_energy"] = df["danceability"] * df["energy"]
-    df["loudness_energy"] = df["loudness"] * df["energy"]
-    df["speech_energy"] = df["speechiness"] * df["energy"]
+# genre flags
+register_feature(GENRE_FLAG_COLS, ["artist_genres_raw"], _genre_flags)
 
-    df["energy_minus_valence"] = df["energy"] - df["valence"]
-    df["dance_minus_acoustic"] = df["danceability"] - df["acousticness"]
-    df["instrumental_minus_speech"] = df["instrumentalness"] - df["speechiness"]
+# simple "is_cover" placeholder: assume 0 (original)
+register_feature("is_cover", [], lambda df: pd.Series(0, index=df.index))
 
-    df["log_tempo"] = np.log1p(df["tempo"].clip(lower=0))
-    df["log_duration"] = np.log1p(df["duration_ms"].clip(lower=0))
+# engineered features
+# These will just be NaN if the base audio features are NaN
+register_feature("energy_valence", ["energy", "valence"],
+                 lambda df: df["energy"] * df["valence"])
+register_feature("dance_energy", ["danceability", "energy"],
+                 lambda df: df["danceability"] * df["energy"])
+register_feature("loudness_energy", ["loudness", "energy"],
+                 lambda df: df["loudness"] * df["energy"])
+register_feature("speech_energy", ["speechiness", "energy"],
+                 lambda df: df["speechiness"] * df["energy"])
 
-    df["tempo_bucket_code"] = df["tempo"].apply(tempo_bucket_code_func)
+register_feature("energy_minus_valence", ["energy", "valence"],
+                 lambda df: df["energy"] - df["valence"])
+register_feature("dance_minus_acoustic", ["danceability", "acousticness"],
+                 lambda df: df["danceability"] - df["acousticness"])
+register_feature("instrumental_minus_speech", ["instrumentalness", "speechiness"],
+                 lambda df: df["instrumentalness"] - df["speechiness"])
 
-    return df
+register_feature("log_tempo", ["tempo"],
+                 lambda df: np.log1p(df["tempo"].clip(lower=0)))
+register_feature("log_duration", ["duration_ms"],
+                 lambda df: np.log1p(df["duration_ms"].clip(lower=0)))
+
+register_feature("tempo_bucket_code", ["tempo"],
+                 lambda df: df["tempo"].apply(tempo_bucket_code_func))
+
+
+def all_known_features():
+    """Every column the registry (or a raw source) can produce."""
+    cols = list(FEATURE_SOURCES)
+    for step in FEATURE_REGISTRY:
+        cols.extend(step["outputs"])
+    return cols
+
+
+def plan_features(features):
+    """
+    Work out what is needed to produce `features`.
+    Returns dict with:
+      - sources: set of raw sources to fetch ("meta", "audio", "artist")
+      - steps:   registered steps to run, in dependency order
+    Features nothing knows how to build (e.g. "explicit") are skipped here;
+    rate_playlist() defaults them to 0 like before.
+    """
+    producers = {}
+    for step in FEATURE_REGISTRY:
+        for out in step["outputs"]:
+            producers[out] = step
+
+    sources = set()
+    steps = []
+    visited = set()
+
+    def visit(col):
+        if col in FEATURE_SOURCES:
+            sources.add(FEATURE_SOURCES[col])
+            return
+        step = producers.get(col)
+        if step is None or id(step) in visited:
+            return
+        visited.add(id(step))
+        for dep in step["inputs"]:
+            visit(dep)
+        steps.append(step)
+
+    for col in features:
+        visit(col)
+
+    return {"sources": sources, "steps": steps}
+
+
+def enrich_playlist_for_model(df_playlist_meta, sp_client, features=None, budget=None) -> pd.DataFrame:
+    """
+    Add the model features to the playlist meta frame.
+    `features` is the list of columns wanted (normally the model's feature
+    names plus any display columns). Only the steps and API calls those
+    columns depend on are run. None = everything in the registry.
+    Returns the meta columns plus the requested features.
+    budget: see make_budget(); fetches that run out of time are left as NaN.
+    """
+    if features is None:
+        features = all_known_features()
+    features = list(features)
+    plan = plan_features(features)
+
+    # 1) start from playlist meta
+    df = df_playlist_meta.copy()
+
+    # 2) audio features (may fail / be empty) -- only if something uses them
+    if "audio" in plan["sources"]:
+        df_audio = fetch_audio_features(df["track_id"].tolist(), sp_client, budget=budget)
+
+        if not df_audio.empty:
+            audio_keep = ["id"] + [c for c in AUDIO_COLS if c in df_audio.columns]
+            # one row per track id, otherwise tracks that appear twice in the
+            # playlist get duplicated again by the merge
+            df_audio = df_audio[audio_keep].drop_duplicates(subset="id")
+            df = df.merge(
+                df_audio, left_on="track_id", right_on="id", how="left"
+            ).drop(columns="id")
+
+        # ensure raw audio feature columns exist even if audio-features failed
+        for col in AUDIO_COLS:
+            if col not in df.columns:
+                df[col] = np.nan
+
+    # 3) artist info -- only if something uses it
+    if "artist" in plan["sources"]:
+        df_art = fetch_artist_info(df["artist_id"].tolist(), sp_client, budget=budget)
+        if df_art.empty:
+            df_art = pd.DataFrame(columns=["artist_id"] + ARTIST_RAW_COLS)
+        df = df.merge(df_art, on="artist_id", how="left")
+
+    # 4) run the planned feature steps in dependency order
+    for step in plan["steps"]:
+        result = step["func"](df)
+        if isinstance(result, pd.DataFrame):
+            for col in step["outputs"]:
+                df[col] = result[col]
+        else:
+            df[step["outputs"][0]] = result
+
+    # 5) keep only meta + requested columns (drop intermediates)
+    keep = list(df_playlist_meta.columns)
+    keep += [c for c in dict.fromkeys(features) if c in df.columns and c not in keep]
+    return df[keep]
 
 
 # ---  ---
@@ -355,12 +840,19 @@ def label_from_score(score_pct: float) -> str:
         return "🚨 Algorithm’s Favorite Child — playlist built by Spotify itself 🚨"
 
 # summarize_playlist()
-def summarize_playlist(df_playlist_enriched, k=20, soft_threshold=0.70):
-
+def summarize_scores(scores, k=20, soft_threshold=0.70):
+    """
+    Playlist summary from the track hit_scores alone (pd.Series).
+    Shared by the in-memory and chunked paths so both give the same numbers.
+    """
+    # background distribution of playlist_index: the recorded reference
+    # once there's enough of it, otherwise the original fixed values
     MU_BG = 0.29   
     SIGMA_BG = 0.1
-
-    scores = df_playlist_enriched["hit_score"]
+    ref_count, ref_mean, ref_std = reference_moments()
+    if ref_count >= REFERENCE_MIN_COUNT and ref_std > 0:
+        MU_BG = ref_mean
+        SIGMA_BG = ref_std
 
     mean_score = scores.mean()
 
@@ -370,10 +862,7 @@ def summarize_playlist(df_playlist_enriched, k=20, soft_threshold=0.70):
 
     playlist_index = 0.2 * mean_score + 0.8 * top_k_mean
 
-    df_playlist_enriched["predicted_hit_soft"] = (
-        df_playlist_enriched["hit_score"] >= soft_threshold
-    ).astype(int)
-    hit_rate_soft = df_playlist_enriched["predicted_hit_soft"].mean()
+    hit_rate_soft = (scores >= soft_threshold).astype(int).mean()
 
     # z score 
     z = (playlist_index - MU_BG) / SIGMA_BG
@@ -391,31 +880,39 @@ def summarize_playlist(df_playlist_enriched, k=20, soft_threshold=0.70):
         "label": label,
         "soft_threshold": soft_threshold,
         "soft_hit_rate": hit_rate_soft,
+        "percentile": playlist_percentile(playlist_index),
+        "reference_count": ref_count,
     }
     return summary
 
-# rate_playlist()
 
-def rate_playlist(
-    playlist_url: str,
-    sp,
-    model,
-    model_features,
-    threshold: float,
-    soft_threshold: float = 0.70,
-    top_k: int = 5,
-    cache_buster=None,
-):
+def summarize_playlist(df_playlist_enriched, k=20, soft_threshold=0.70):
+
+    df_playlist_enriched["predicted_hit_soft"] = (
+        df_playlist_enriched["hit_score"] >= soft_threshold
+    ).astype(int)
+
+    return summarize_scores(
+        df_playlist_enriched["hit_score"], k=k, soft_threshold=soft_threshold
+    )
+
+# score_tracks()
+
+# columns used for the top / bottom tables in the app
+DISPLAY_COLS = ["track_name", "artist_name", "year", "hit_score", "album_image_url", "album_images"]
+
+def score_tracks(df_playlist_meta, sp, model, model_features, threshold: float, budget=None) -> pd.DataFrame:
     """
-    Given a Spotify playlist URL, return:
-      - summary dict
-      - top_k most 'hit-like' tracks (DataFrame)
-      - bottom_k least 'hit-like' tracks (DataFrame)
-      - full scored playlist DataFrame
+    Enrich a frame of playlist tracks and attach hit_score / predicted_hit.
     """
-    # 1) Load + enrich playlist
-    df_playlist_meta = load_playlist_tracks(playlist_url, sp)
-    df_playlist_enriched = enrich_playlist_for_model(df_playlist_meta, sp)
+    # 1) Enrich (only what the model, display and playlist embedding need --
+    # the embedding always gets every EMBED_FEATURES column, whatever the
+    # model uses, so stored vectors stay comparable)
+    df_playlist_enriched = enrich_playlist_for_model(
+        df_playlist_meta, sp,
+        features=list(model_features) + DISPLAY_COLS + list(EMBED_FEATURES),
+        budget=budget,
+    )
 
     # 2) Ensure every model feature exists
     for col in model_features:
@@ -437,27 +934,26 @@ def rate_playlist(
     df_playlist_enriched["predicted_hit"] = (
         df_playlist_enriched["hit_score"] >= threshold
     ).astype(int)
+    df_playlist_enriched["degraded"] = degraded_mask(df_playlist_enriched, budget)
 
-    # 5) Summary using existing logic
-    summary = summarize_playlist(
-        df_playlist_enriched,
-        k=20,
-        soft_threshold=soft_threshold,
-    )
+    return df_playlist_enriched
 
-    # 6) Top / bottom tables for display
-    display_cols = ["track_name", "artist_name", "year", "hit_score", "album_image_url"]
 
+def top_bottom_tracks(df_scored, top_k: int = 5):
+    """
+    Top / bottom tables for display, one row per (track_name, artist_name).
+    Stable sort so ties keep playlist order (the chunked path relies on this).
+    """
     # Remove duplicates
-    deduped = df_playlist_enriched.drop_duplicates(
+    deduped = df_scored.drop_duplicates(
         subset=["track_name", "artist_name"]
     )
 
     # Top K
     top = (
         deduped
-        .sort_values("hit_score", ascending=False)
-        [display_cols]
+        .sort_values("hit_score", ascending=False, kind="stable")
+        [DISPLAY_COLS]
         .head(top_k)
         .reset_index(drop=True)
     )
@@ -465,12 +961,1521 @@ def rate_playlist(
     # Bottom K
     bottom = (
         deduped
-        .sort_values("hit_score", ascending=True)
-        [display_cols]
+        .sort_values("hit_score", ascending=True, kind="stable")
+        [DISPLAY_COLS]
         .head(top_k)
         .reset_index(drop=True)
     )
 
+    return top, bottom
+
+
+def degraded_mask(df_scored, budget) -> pd.Series:
+    """True for tracks missing audio or artist data because time ran out."""
+    if budget is None:
+        return pd.Series(False, index=df_scored.index)
+    return df_scored["track_id"].isin(set(budget["audio_timed_out"])) | df_scored[
+        "artist_id"
+    ].isin(set(budget["artist_timed_out"]))
+
+
+def degraded_track_ids(df_scored, budget):
+    """track_ids of the tracks score_tracks() flagged as degraded."""
+    if budget is None:
+        return []
+    return df_scored.loc[df_scored["degraded"], "track_id"].tolist()
+
+
+def degraded_summary(budget, model_features, track_ids, n_scored):
+    """
+    What a deadline cost us, for summary["degraded"]. None without a deadline.
+      - tracks: track_ids scored with defaulted features
+      - features: model features that were defaulted for those tracks
+      - tracks_skipped: tracks never loaded because paging stopped early
+    """
+    if budget is None:
+        return None
+    sources = set()
+    if budget["audio_timed_out"]:
+        sources.add("audio")
+    if budget["artist_timed_out"]:
+        sources.add("artist")
+    features = [
+        f for f in model_features
+        if sources & plan_features([f])["sources"]
+    ]
+    skipped = 0
+    if budget["truncated"] and budget["tracks_total"]:
+        # tracks_total counts podcasts / local files too, so this is an upper bound
+        skipped = max(0, budget["tracks_total"] - n_scored)
+    return {
+        "tracks": list(dict.fromkeys(track_ids)),
+        "features": features,
+        "truncated": budget["truncated"],
+        "tracks_skipped": skipped,
+        "any": bool(track_ids) or budget["truncated"],
+    }
+
+
+# columns shown in the app's full results view
+RESULTS_COLS = ["track_name", "artist_name", "year", "hit_score"]
+
+def results_table(df_scored) -> pd.DataFrame:
+    """
+    Slim copy of the scored playlist with just the columns the results view
+    shows (no genre lists / model features), in playlist order.
+    """
+    cols = [c for c in RESULTS_COLS if c in df_scored.columns]
+    return df_scored[cols].reset_index(drop=True)
+
+# rate_playlist()
+
+def rate_playlist(
+    playlist_url: str,
+    sp,
+    model,
+    model_features,
+    threshold: float,
+    soft_threshold: float = 0.70,
+    top_k: int = 5,
+    cache_buster=None,
+    chunk_size=None,
+    deadline=None,
+):
+    """
+    Given a Spotify playlist URL, return:
+      - summary dict
+      - top_k most 'hit-like' tracks (DataFrame)
+      - bottom_k least 'hit-like' tracks (DataFrame)
+      - full scored playlist DataFrame
+
+    chunk_size: if set, tracks go through fetch / enrich / predict chunk_size
+    at a time and only the scores are kept, so memory doesn't grow with the
+    playlist. The summary and top / bottom tables are the same as the
+    in-memory path, but the last item is then just the hit_score column.
+
+    deadline: time budget in seconds. Paging and the audio / artist fetches
+    stop waiting when it runs out; whatever is missing is scored as 0 (same
+    as any missing feature) and listed in summary["degraded"]. A degraded
+    rating is stored with its tracks flagged, but doesn't go into the
+    rating reference or the playlist embeddings.
+    """
+    budget = make_budget(deadline) if deadline else None
+    record = new_rating_record(playlist_url, model)
+
+    if chunk_size:
+        return _rate_playlist_chunked(
+            playlist_url, sp, model, model_features, threshold,
+            soft_threshold=soft_threshold, top_k=top_k, chunk_size=chunk_size,
+            budget=budget, record=record,
+        )
+
+    # 1) Load + score playlist
+    df_playlist_meta = load_playlist_tracks(playlist_url, sp, budget=budget)
+    df_playlist_enriched = score_tracks(
+        df_playlist_meta, sp, model, model_features, threshold, budget=budget
+    )
+    write_scored_tracks(df_playlist_enriched, record, model_features)
+    finish_scored_tracks(record)
+
+    # 2) Summary using existing logic
+    summary = summarize_playlist(
+        df_playlist_enriched,
+        k=20,
+        soft_threshold=soft_threshold,
+    )
+
+    summary["degraded"] = degraded_summary(
+        budget, model_features, degraded_track_ids(df_playlist_enriched, budget), len(df_playlist_enriched)
+    )
+    complete = not (summary["degraded"] and summary["degraded"]["any"])
+    if complete:
+        record_playlist_index(playlist_url, summary["playlist_index"])
+    summary["rating_id"] = record["rating_id"]
+    write_rating_summary(summary, record, len(df_playlist_enriched))
+
+    # 3) Playlist embedding (for "playlists like yours"); a degraded rating
+    # is still compared against the store but not added to it
+    summary["embedding"] = playlist_embedding_from_scored(df_playlist_enriched)
+    if complete:
+        record_playlist_embedding(playlist_url, summary["embedding"], summary)
+
+    # 4) Top / bottom tables for display
+    top, bottom = top_bottom_tracks(df_playlist_enriched, top_k=top_k)
 
     return summary, top, bottom, df_playlist_enriched
 
+
+def _merge_candidates(candidates, fresh, top_k, ascending):
+    """
+    Add a chunk's rows to the running top (or bottom) candidates and keep
+    the best top_k, one row per (track_name, artist_name).
+
+    Duplicates are only checked against the candidates, so memory stays
+    bounded. A repeat whose first occurrence was already dropped can't get
+    back in when it has the same score (the same track listed twice).
+    Only a same-name track with a *different* score can then differ from
+    the in-memory path.
+    """
+    pool = fresh if candidates is None else pd.concat([candidates, fresh])
+    # candidates stay in playlist order, so keep="first" and the stable sort
+    # in top_bottom_tracks() break ties like the in-memory path
+    pool = pool.drop_duplicates(subset=["track_name", "artist_name"], keep="first")
+    return (
+        pool.sort_values("hit_score", ascending=ascending, kind="stable")
+        .head(top_k)
+        .sort_index(kind="stable")
+    )
+
+
+def _rate_playlist_chunked(
+    playlist_url, sp, model, model_features, threshold,
+    soft_threshold=0.70, top_k=5, chunk_size=500, budget=None, record=None,
+):
+    """
+    Chunked version of rate_playlist(). Between chunks we only keep:
+      - the hit_score array of each chunk (for the summary)
+      - the current top_k / bottom_k candidate rows
+      - the running sum / top-EMBED_TOP_K rows for the playlist embedding
+    Each scored chunk goes into the results store as a row group as it goes.
+    """
+    if record is None:
+        record = new_rating_record(playlist_url, model)
+    score_chunks = []
+    embed_sum = np.zeros(len(EMBED_FEATURES))
+    embed_top_scores = np.empty(0, dtype=np.float32)
+    embed_top_rows = np.empty((0, len(EMBED_FEATURES)), dtype=np.float32)
+    n_scored = 0
+    top = None
+    bottom = None
+
+    degraded_ids = []
+
+    try:
+        for df_chunk in iter_playlist_track_chunks(playlist_url, sp, chunk_size=chunk_size, budget=budget):
+            df_scored = score_tracks(df_chunk, sp, model, model_features, threshold, budget=budget)
+            score_chunks.append(df_scored["hit_score"].to_numpy())
+            degraded_ids.extend(degraded_track_ids(df_scored, budget))
+            write_scored_tracks(df_scored, record, model_features)
+
+            rows = embedding_rows(df_scored)
+            embed_sum += rows.sum(axis=0, dtype=np.float64)
+            embed_top_scores, embed_top_rows = _top_rows(
+                np.concatenate([embed_top_scores, df_scored["hit_score"].to_numpy()]),
+                np.vstack([embed_top_rows, rows]),
+                EMBED_TOP_K,
+            )
+
+            fresh = df_scored[DISPLAY_COLS]
+            fresh.index = fresh.index + n_scored   # index = position in the playlist
+            n_scored += len(df_scored)
+
+            top = _merge_candidates(top, fresh, top_k, ascending=False)
+            bottom = _merge_candidates(bottom, fresh, top_k, ascending=True)
+
+            del df_scored, df_chunk
+    except BaseException:
+        finish_scored_tracks(record, keep=False)  # no half-stored ratings
+        raise
+    finish_scored_tracks(record)
+
+    scores = pd.Series(
+        np.concatenate(score_chunks) if score_chunks else np.array([], dtype=np.float32),
+        name="hit_score",
+    )
+    summary = summarize_scores(scores, k=20, soft_threshold=soft_threshold)
+    summary["degraded"] = degraded_summary(budget, model_features, degraded_ids, len(scores))
+    complete = not (summary["degraded"] and summary["degraded"]["any"])
+    if complete:
+        record_playlist_index(playlist_url, summary["playlist_index"])
+    summary["rating_id"] = record["rating_id"]
+    write_rating_summary(summary, record, len(scores))
+
+    summary["embedding"] = playlist_embedding(embed_sum, len(scores), embed_top_rows)
+    if complete:
+        record_playlist_embedding(playlist_url, summary["embedding"], summary)
+
+    top, _ = top_bottom_tracks(top, top_k=top_k)
+    _, bottom = top_bottom_tracks(bottom, top_k=top_k)
+
+    return summary, top, bottom, scores.to_frame()
+
+
+# ----------------------------------------------------------
+# 6) ALBUM ART
+# ----------------------------------------------------------
+# Covers are picked at the smallest size that still fills the tile, and
+# downloaded once into a local content-addressed cache (blob file named by
+# the sha256 of the image bytes, plus a url -> digest index). The cache is
+# LRU by url and trimmed to THUMB_CACHE_MAX_BYTES.
+
+THUMB_CACHE_DIR = ".thumb_cache"
+THUMB_CACHE_MAX_BYTES = 50 * 1024 * 1024
+
+_thumb_lock = threading.Lock()
+_thumb_index = None          # OrderedDict url -> digest, least recently used first
+_thumb_sizes = {}            # digest -> bytes on disk
+
+
+def pick_album_image(images, display_width: int):
+    """
+    From album_images (smallest first) return the url of the smallest image
+    at least display_width px wide; the largest one if none is big enough.
+    """
+    if not isinstance(images, list) or not images:
+        return None
+    for img in images:
+        if (img.get("width") or 0) >= display_width:
+            return img["url"]
+    return images[-1]["url"]
+
+
+def _thumb_index_path():
+    return os.path.join(THUMB_CACHE_DIR, "index.json")
+
+
+def _thumb_blob_path(digest):
+    return os.path.join(THUMB_CACHE_DIR, digest)
+
+
+def _load_thumb_index():
+    """Read the url -> digest index from disk (once per process)."""
+    global _thumb_index
+    if _thumb_index is not None:
+        return
+    _thumb_index = OrderedDict()
+    os.makedirs(THUMB_CACHE_DIR, exist_ok=True)
+    try:
+        with open(_thumb_index_path()) as f:
+            entries = json.load(f)
+    except (OSError, ValueError):
+        entries = []
+    for url, digest in entries:
+        path = _thumb_blob_path(digest)
+        if os.path.exists(path):
+            _thumb_index[url] = digest
+            _thumb_sizes[digest] = os.path.getsize(path)
+
+
+def _save_thumb_index():
+    tmp_path = _thumb_index_path() + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(list(_thumb_index.items()), f)
+    os.replace(tmp_path, _thumb_index_path())
+
+
+def _evict_thumbnails():
+    """Drop least recently used urls until the blobs fit the byte budget."""
+    while _thumb_index and sum(_thumb_sizes.values()) > THUMB_CACHE_MAX_BYTES:
+        _, digest = _thumb_index.popitem(last=False)
+        if digest in _thumb_index.values():
+            continue  # same image still referenced by another url
+        _thumb_sizes.pop(digest, None)
+        try:
+            os.remove(_thumb_blob_path(digest))
+        except OSError:
+            pass
+
+
+def get_thumbnail(url, timeout: float = 5.0):
+    """
+    Return the image bytes for url, from the local cache if we have them,
+    otherwise downloaded once and cached. None if the download fails.
+    """
+    if not url:
+        return None
+
+    with _thumb_lock:
+        _load_thumb_index()
+        digest = _thumb_index.get(url)
+        if digest is not None:
+            try:
+                with open(_thumb_blob_path(digest), "rb") as f:
+                    data = f.read()
+                _thumb_index.move_to_end(url)
+                return data
+            except OSError:
+                # blob vanished underneath us, fetch (and write) it again
+                del _thumb_index[url]
+                _thumb_sizes.pop(digest, None)
+
+    try:
+        resp = requests.get(url, timeout=timeout)
+        resp.raise_for_status()
+    except requests.RequestException as e:
+        print(f"⚠️ Could not fetch album art {url}: {e}")
+        return None
+    data = resp.content
+
+    digest = hashlib.sha256(data).hexdigest()
+    with _thumb_lock:
+        path = _thumb_blob_path(digest)
+        if digest not in _thumb_sizes or not os.path.exists(path):
+            tmp_path = path + ".tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+            _thumb_sizes[digest] = len(data)
+        _thumb_index[url] = digest
+        _thumb_index.move_to_end(url)
+        _evict_thumbnails()
+        _save_thumb_index()
+
+    return data
+
+
+# ----------------------------------------------------------
+# 7) SCORE EXPLANATIONS
+# ----------------------------------------------------------
+# Per-track feature contributions straight from the booster
+# (pred_contribs=True, i.e. SHAP values in log-odds space, last column is
+# the bias). Nothing here runs while rating -- the app calls
+# explain_tracks() the first time someone opens an explanation, for the
+# whole scored matrix in one batch, and results are cached per
+# (model version, track_id) so they're never recomputed.
+
+EXPLAIN_CACHE_MAX = 50_000   # cached tracks (one float32 row each)
+
+_explain_lock = threading.Lock()
+_explain_cache = OrderedDict()   # (model_version, track_id) -> contributions
+_model_versions = {}             # id(model) -> version string
+
+
+def model_version(model) -> str:
+    """Short content hash of the trained booster, e.g. "3f2a9c01b7de"."""
+    key = id(model)
+    if key not in _model_versions:
+        raw = model.get_booster().save_raw()
+        _model_versions[key] = hashlib.sha256(bytes(raw)).hexdigest()[:12]
+    return _model_versions[key]
+
+
+def explain_tracks(model, X, track_ids, no_cache=None) -> pd.DataFrame:
+    """
+    Feature contributions for the rows of X (the model feature matrix the
+    tracks were scored with). Only tracks not already cached are sent to
+    the booster, in one batch.
+    no_cache: optional bool per row; those rows (e.g. tracks scored with
+    deadline-defaulted features) are neither read from nor added to the
+    cache, since their X differs from a full rating's.
+    Returns df: one row per track (same order as X), one column per model
+    feature plus "bias"; each row sums to the track's log-odds.
+    """
+    booster = model.get_booster()
+    features = list(booster.feature_names)
+    version = model_version(model)
+    X = np.asarray(X, dtype=np.float32)
+    track_ids = list(track_ids)
+    if no_cache is not None:
+        # None = don't key this row (same as local files without an id)
+        track_ids = [None if skip else tid for tid, skip in zip(track_ids, no_cache)]
+
+    rows = [None] * len(track_ids)
+    missing = []
+    with _explain_lock:
+        for i, tid in enumerate(track_ids):
+            cached = _explain_cache.get((version, tid)) if tid is not None else None
+            if cached is None:
+                missing.append(i)
+            else:
+                _explain_cache.move_to_end((version, tid))
+                rows[i] = cached
+
+    if missing:
+        dmat = xgb.DMatrix(X[missing], feature_names=features)
+        contribs = booster.predict(dmat, pred_contribs=True).astype(np.float32)
+
+        with _explain_lock:
+            for i, row in zip(missing, contribs):
+                rows[i] = row
+                tid = track_ids[i]
+                if tid is None:
+                    continue  # local files etc. -- nothing stable to key on
+                _explain_cache[(version, tid)] = row
+                _explain_cache.move_to_end((version, tid))
+            while len(_explain_cache) > EXPLAIN_CACHE_MAX:
+                _explain_cache.popitem(last=False)
+
+    return pd.DataFrame(
+        np.vstack(rows) if rows else np.empty((0, len(features) + 1), dtype=np.float32),
+        columns=features + ["bias"],
+    )
+
+
+def top_contributions(contribs_row, X_row, n: int = 8) -> pd.DataFrame:
+    """
+    The n features that moved one track's score the most.
+    contribs_row: one row of explain_tracks(); X_row: that track's features.
+    Returns df with columns: feature, value, contribution (largest |contribution| first).
+    """
+    contribs = contribs_row.drop("bias")
+    order = contribs.abs().sort_values(ascending=False, kind="stable").index[:n]
+    return pd.DataFrame(
+        {
+            "feature": order,
+            "value": [X_row[f] for f in order],
+            "contribution": contribs[order].to_numpy(),
+        }
+    )
+
+
+# ----------------------------------------------------------
+# 8) RATING CACHE + WARM-UP
+# ----------------------------------------------------------
+# Recent ratings of the hot playlists (the ones passed to start_warmup(),
+# above all the app's default one) are kept for a few minutes so they aren't
+# re-rated from scratch for every visitor. Any other playlist is always
+# rated fresh, so a user who just edited theirs sees the change.
+# start_warmup() runs once per worker, in a background thread: it checks the
+# OAuth token, pushes a dummy row through the model, then pre-rates the hot
+# playlists (which also fills the artist cache). warmup_status() reports
+# how far it got.
+
+RATING_CACHE_TTL = 15 * 60   # seconds
+RATING_CACHE_MAX = 32        # playlists
+
+_rating_lock = threading.Lock()
+_rating_cache = OrderedDict()   # key -> (rated_at, (summary, top, bottom, df_scored))
+_rating_inflight = {}           # key -> {"done": Event set when that rating finishes, "result": ...}
+
+_warmup = {
+    "started": False,
+    "model": False,
+    "token": False,
+    "playlists": {},            # playlist url -> "pending" / "done" / "error: ..."
+    "hot_ids": set(),           # playlist ids rate_playlist_cached() may cache
+    "ready": threading.Event(),
+}
+
+
+def _rating_key(playlist_url, model, threshold, soft_threshold, top_k):
+    return (
+        extract_playlist_id(playlist_url),
+        model_version(model),
+        threshold,
+        soft_threshold,
+        top_k,
+    )
+
+
+def rate_playlist_cached(
+    playlist_url: str,
+    sp,
+    model,
+    model_features,
+    threshold: float,
+    soft_threshold: float = 0.70,
+    top_k: int = 5,
+    wait_timeout: float = 60,
+    deadline=None,
+    cache_buster=None,
+):
+    """
+    rate_playlist() with a short-lived cache in front of it, for the hot
+    playlists only; anything else goes straight to rate_playlist() (with
+    cache_buster). If a hot playlist is being rated right now (e.g. by the
+    warm-up), waits for that result instead of rating it a second time --
+    degraded or not. The deadline covers the wait: rating it ourselves after
+    giving up only gets the seconds that are left.
+    Ratings degraded by the deadline are returned but not cached.
+    The returned frames are shared between sessions -- don't modify them.
+    """
+    started = time.monotonic()
+    if extract_playlist_id(playlist_url) not in _warmup["hot_ids"]:
+        return rate_playlist(
+            playlist_url=playlist_url,
+            sp=sp,
+            model=model,
+            model_features=model_features,
+            threshold=threshold,
+            soft_threshold=soft_threshold,
+            top_k=top_k,
+            cache_buster=cache_buster,
+            deadline=deadline,
+        )
+
+    key = _rating_key(playlist_url, model, threshold, soft_threshold, top_k)
+
+    def seconds_left():
+        return (deadline or wait_timeout) - (time.monotonic() - started)
+
+    while True:
+        with _rating_lock:
+            cached = _rating_cache.get(key)
+            if cached is not None and time.time() - cached[0] < RATING_CACHE_TTL:
+                _rating_cache.move_to_end(key)
+                return cached[1]
+            inflight = _rating_inflight.get(key)
+            if inflight is None:
+                inflight = {"done": threading.Event(), "result": None}
+                _rating_inflight[key] = inflight
+                break
+        # someone else is rating it -- wait for their result (None if it failed)
+        if not inflight["done"].wait(timeout=max(0.0, seconds_left())):
+            inflight = {"done": threading.Event(), "result": None}  # gave up, rate it ourselves
+            break
+        if inflight["result"] is not None:
+            return inflight["result"]
+
+    if deadline:
+        deadline = max(seconds_left(), 1e-3)  # what's left of it (0 would mean no deadline)
+    try:
+        result = rate_playlist(
+            playlist_url=playlist_url,
+            sp=sp,
+            model=model,
+            model_features=model_features,
+            threshold=threshold,
+            soft_threshold=soft_threshold,
+            top_k=top_k,
+            deadline=deadline,
+        )
+        degraded = result[0].get("degraded")
+        if not (degraded and degraded["any"]):
+            with _rating_lock:
+                _rating_cache[key] = (time.time(), result)
+                _rating_cache.move_to_end(key)
+                while len(_rating_cache) > RATING_CACHE_MAX:
+                    _rating_cache.popitem(last=False)
+        inflight["result"] = result
+        return result
+    finally:
+        with _rating_lock:
+            if _rating_inflight.get(key) is inflight:
+                del _rating_inflight[key]
+        inflight["done"].set()
+
+
+def _warm_token():
+    """
+    Make sure a valid token is loaded (refreshing it if needed) without
+    ever starting the interactive login flow.
+    """
+    # same lock as get_access_token(), so a refresh here can't race the
+    # pooled clients' and rewrite .cache at the same time
+    with auth_manager._token_lock:
+        token = auth_manager.validate_token(auth_manager.cache_handler.get_cached_token())
+    _warmup["token"] = token is not None
+    if token is None:
+        print("⚠️ Warm-up: no cached Spotify token; first rating will need to log in.")
+
+
+def _warm_model(model):
+    """One dummy prediction so xgboost's first-call setup isn't paid by a user."""
+    features = list(model.get_booster().feature_names)
+    model.predict_proba(pd.DataFrame(np.zeros((1, len(features))), columns=features))
+    _warmup["model"] = True
+
+
+def _warm_all(playlist_urls, model, threshold):
+    try:
+        _warm_token()
+    except Exception as e:
+        print(f"⚠️ Warm-up: token check failed: {e}")
+    try:
+        _warm_model(model)
+    except Exception as e:
+        print(f"⚠️ Warm-up: model warm-up failed: {e}")
+
+    model_features = list(model.get_booster().feature_names)
+    for url in playlist_urls:
+        try:
+            with spotify_client() as sp_client:
+                rate_playlist_cached(url, sp_client, model, model_features, threshold)
+            _warmup["playlists"][url] = "done"
+        except Exception as e:
+            _warmup["playlists"][url] = f"error: {e}"
+            print(f"⚠️ Warm-up: could not pre-rate {url}: {e}")
+    _warmup["ready"].set()
+    print(f"Warm-up finished: {warmup_status()}")
+
+
+def start_warmup(hot_playlists=(), model=None, threshold=None):
+    """
+    Warm this worker up in a background thread (token, model, then the hot
+    playlists) and return straight away. Only runs once per process.
+    Returns warmup_status().
+    """
+    model = best_xgb_full if model is None else model
+    threshold = best_threshold_full if threshold is None else threshold
+
+    with _rating_lock:
+        if _warmup["started"]:
+            return warmup_status()
+        _warmup["started"] = True
+
+    hot_playlists = list(dict.fromkeys(hot_playlists))
+    for url in hot_playlists:
+        _warmup["playlists"][url] = "pending"
+        _warmup["hot_ids"].add(extract_playlist_id(url))
+
+    threading.Thread(
+        target=_warm_all,
+        args=(hot_playlists, model, threshold),
+        name="worker-warmup",
+        daemon=True,
+    ).start()
+
+    return warmup_status()
+
+
+def warmup_status() -> dict:
+    """
+    Readiness of this worker:
+      - started: start_warmup() has been called in this process
+      - model / token: True once warmed up
+      - playlists: per hot playlist "pending" / "done" / "error: ..."
+      - ready: True once the warm-up thread has finished
+    """
+    return {
+        "started": _warmup["started"],
+        "model": _warmup["model"],
+        "token": _warmup["token"],
+        "playlists": dict(_warmup["playlists"]),
+        "ready": _warmup["ready"].is_set(),
+    }
+
+
+# hot playlists to pre-rate at startup (the app adds its default playlist)
+HOT_PLAYLISTS = list(st.secrets.get("HOT_PLAYLISTS", []))
+
+# time budget (seconds) for an interactive rating, see rate_playlist(deadline=...)
+RATING_DEADLINE = float(st.secrets.get("RATING_DEADLINE", 20))
+
+
+# ----------------------------------------------------------
+# 9) RATING REFERENCE DISTRIBUTION
+# ----------------------------------------------------------
+# The latest playlist_index of every rated playlist is kept in a reference
+# distribution that lives on disk between restarts:
+#   - streaming moments (count / mean / M2, Welford) -> replace the
+#     hard-coded MU_BG / SIGMA_BG once there are enough playlists
+#   - a fixed-resolution histogram over [0, 1] kept as a Fenwick tree, so
+#     adding a rating and looking up a percentile are both O(log bins),
+#     no matter how many playlists are stored
+# Each playlist counts once: re-rating it replaces its previous index, so
+# the hot playlists (re-rated on every cache expiry / warm-up) don't pile
+# up. The latest index per playlist lives in a small sqlite table that is
+# only ever looked up for the one playlist being recorded; the .npz (moments
+# + tree) stays the same size however many playlists are stored.
+# Updates from several worker processes are merged through the files: a
+# writer takes a file lock, re-reads the .npz if another process changed
+# it, applies its change and writes it back.
+
+REFERENCE_PATH = "rating_reference.npz"
+REFERENCE_LATEST_PATH = "rating_reference_latest.sqlite"   # playlist id -> latest index
+REFERENCE_BINS = 10_000          # playlist_index resolution of 1e-4
+REFERENCE_MIN_COUNT = 200        # below this, keep the fixed MU_BG / SIGMA_BG
+
+_reference_lock = threading.Lock()
+_reference = None                # dict: count, mean, m2, tree, mtime
+
+
+def _reference_mtime():
+    try:
+        return os.stat(REFERENCE_PATH).st_mtime_ns
+    except OSError:
+        return None
+
+
+def _load_reference():
+    """Read the reference distribution from disk if it changed since last time."""
+    global _reference
+    mtime = _reference_mtime()
+    if _reference is not None and _reference["mtime"] == mtime:
+        return
+    _reference = {
+        "count": 0,
+        "mean": 0.0,
+        "m2": 0.0,
+        "tree": np.zeros(REFERENCE_BINS + 1, dtype=np.int64),
+        "mtime": mtime,
+    }
+    try:
+        with np.load(REFERENCE_PATH) as saved:
+            if len(saved["tree"]) == REFERENCE_BINS + 1:
+                _reference["count"] = int(saved["count"])
+                _reference["mean"] = float(saved["mean"])
+                _reference["m2"] = float(saved["m2"])
+                _reference["tree"] = saved["tree"].astype(np.int64)
+    except (OSError, KeyError, ValueError):
+        pass
+
+
+def _save_reference():
+    tmp_path = REFERENCE_PATH + ".tmp.npz"
+    np.savez(
+        tmp_path,
+        count=_reference["count"],
+        mean=_reference["mean"],
+        m2=_reference["m2"],
+        tree=_reference["tree"],
+    )
+    os.replace(tmp_path, REFERENCE_PATH)
+    _reference["mtime"] = _reference_mtime()
+
+
+@contextmanager
+def _file_lock(lock_path):
+    """Exclusive lock shared by every worker process (no-op without fcntl)."""
+    if fcntl is None:
+        yield
+        return
+    with open(lock_path, "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _reference_bin(playlist_index) -> int:
+    return min(int(np.clip(playlist_index, 0, 1) * REFERENCE_BINS), REFERENCE_BINS - 1)
+
+
+def _fenwick_add(tree, i, n=1):
+    i += 1
+    while i < len(tree):
+        tree[i] += n
+        i += i & -i
+
+
+def _fenwick_prefix(tree, i) -> int:
+    """Number of stored ratings in bins [0, i)."""
+    total = 0
+    while i > 0:
+        total += tree[i]
+        i -= i & -i
+    return int(total)
+
+
+def _reference_remove(ref, x):
+    """Undo one Welford / histogram update for value x."""
+    ref["count"] -= 1
+    if ref["count"] <= 0:
+        ref["count"], ref["mean"], ref["m2"] = 0, 0.0, 0.0
+    else:
+        delta = x - ref["mean"]
+        ref["mean"] -= delta / ref["count"]
+        ref["m2"] = max(ref["m2"] - delta * (x - ref["mean"]), 0.0)
+    _fenwick_add(ref["tree"], _reference_bin(x), -1)
+
+
+def record_playlist_index(playlist_ref, playlist_index):
+    """
+    Set a playlist's playlist_index in the reference distribution (replacing
+    the one from its previous rating, if any) and persist it.
+    """
+    global _reference
+    x = float(playlist_index)
+    if np.isnan(x):
+        return
+    playlist_id = extract_playlist_id(playlist_ref)
+    # file lock first: readers in this process only wait for the (small)
+    # update itself, never for another worker
+    try:
+        with _file_lock(REFERENCE_PATH + ".lock"):
+            db = sqlite3.connect(REFERENCE_LATEST_PATH)
+            try:
+                # the row is only committed (on leaving `with db`) once the .npz is saved
+                with db:
+                    db.execute(
+                        "CREATE TABLE IF NOT EXISTS latest"
+                        " (playlist_id TEXT PRIMARY KEY, playlist_index REAL)"
+                    )
+                    row = db.execute(
+                        "SELECT playlist_index FROM latest WHERE playlist_id = ?", (playlist_id,)
+                    ).fetchone()
+                    db.execute("INSERT OR REPLACE INTO latest VALUES (?, ?)", (playlist_id, x))
+
+                    with _reference_lock:
+                        _load_reference()
+                        ref = _reference
+                        if row is not None:
+                            _reference_remove(ref, row[0])
+                        ref["count"] += 1
+                        delta = x - ref["mean"]
+                        ref["mean"] += delta / ref["count"]
+                        ref["m2"] += delta * (x - ref["mean"])
+                        _fenwick_add(ref["tree"], _reference_bin(x))
+                        try:
+                            _save_reference()
+                        except OSError:
+                            _reference = None   # drop the unsaved change, reload next time
+                            raise
+            finally:
+                db.close()
+    except (OSError, sqlite3.Error) as e:
+        print(f"⚠️ Could not save rating reference: {e}")
+
+
+def reference_moments():
+    """(count, mean, std) of the latest playlist_index of every rated playlist."""
+    with _reference_lock:
+        _load_reference()
+        count = _reference["count"]
+        mean = _reference["mean"]
+        std = float(np.sqrt(_reference["m2"] / (count - 1))) if count > 1 else 0.0
+    return count, mean, std
+
+
+def playlist_percentile(playlist_index):
+    """
+    Share (0-100) of recorded playlists with a lower playlist_index; ties
+    within the same bin count half. None if nothing has been recorded yet.
+    """
+    x = float(playlist_index)
+    with _reference_lock:
+        _load_reference()
+        count = _reference["count"]
+        if count == 0 or np.isnan(x):
+            return None
+        i = _reference_bin(x)
+        below = _fenwick_prefix(_reference["tree"], i)
+        same = _fenwick_prefix(_reference["tree"], i + 1) - below
+    return round(100 * (below + 0.5 * same) / count, 1)
+
+
+# ----------------------------------------------------------
+# 10) PLAYLIST EMBEDDINGS + NEAREST NEIGHBOURS
+# ----------------------------------------------------------
+# Each rated playlist gets a small vector: the mean of its tracks' (scaled)
+# features followed by the mean over its EMBED_TOP_K most hit-like tracks.
+# Vectors are appended to one float32 file (row i <-> line i of the meta
+# jsonl) and searched by cosine similarity in blocks. For big stores,
+# build_embedding_index() adds a coarse k-means index so a search only
+# scores the rows in the nprobe closest clusters.
+
+# feature -> (offset, scale), so every dimension lands roughly in [0, 1]
+EMBED_FEATURES = {
+    "danceability": (0, 1),
+    "energy": (0, 1),
+    "valence": (0, 1),
+    "acousticness": (0, 1),
+    "instrumentalness": (0, 1),
+    "speechiness": (0, 1),
+    "liveness": (0, 1),
+    "loudness": (-60, 60),
+    "tempo": (0, 200),
+    "duration_ms": (0, 600_000),
+    "year": (1950, 75),
+    "artist_popularity": (0, 100),
+    "artist_followers_log": (0, 18),
+    **{col: (0, 1) for col in GENRE_FLAG_COLS if col != "num_genres"},
+}
+EMBED_TOP_K = 20
+EMBED_DIM = 2 * len(EMBED_FEATURES)
+
+EMBED_DIR = "playlist_vectors"
+EMBED_BLOCK_ROWS = 65_536        # rows scored per matmul block
+
+_embed_lock = threading.Lock()
+_embed_index = None              # coarse index from build_embedding_index()
+_embed_cache = {}                # see _reset_embed_cache()
+
+
+def _reset_embed_cache(meta_path=None):
+    _embed_cache.update(
+        path=meta_path,
+        meta=[],
+        offset=0,
+        norms=np.empty(0, dtype=np.float32),
+        codes=np.empty(0, dtype=np.int32),    # row -> playlist code
+        latest=np.empty(0, dtype=bool),       # row is its playlist's latest rating
+        playlist_codes={},                    # playlist id -> code
+        latest_rows=[],                       # code -> row of the latest rating
+    )
+
+
+_reset_embed_cache()
+
+
+def _embed_paths():
+    return (
+        os.path.join(EMBED_DIR, f"vectors_{EMBED_DIM}.f32"),
+        os.path.join(EMBED_DIR, f"meta_{EMBED_DIM}.jsonl"),
+    )
+
+
+def embedding_rows(df_scored) -> np.ndarray:
+    """Scaled EMBED_FEATURES of every track, float32 (n_tracks x n_features)."""
+    df = df_scored.reindex(columns=list(EMBED_FEATURES))
+    df = df.apply(pd.to_numeric, errors="coerce")
+    offsets = np.array([o for o, _ in EMBED_FEATURES.values()], dtype=np.float64)
+    scales = np.array([s for _, s in EMBED_FEATURES.values()], dtype=np.float64)
+    rows = (df.to_numpy(dtype=np.float64) - offsets) / scales
+    # missing values (e.g. no audio features) sit at 0 like in the model input
+    return np.nan_to_num(rows, nan=0.0).astype(np.float32)
+
+
+def _top_rows(scores, rows, k):
+    """The k rows with the highest scores, ties in playlist order."""
+    order = np.argsort(-np.asarray(scores, dtype=np.float64), kind="stable")[:k]
+    return np.asarray(scores)[np.sort(order)], rows[np.sort(order)]
+
+
+def playlist_embedding(row_sum, n_rows, top_rows) -> np.ndarray:
+    """[mean of all track rows, mean of the top-k track rows] as float32."""
+    n_features = len(EMBED_FEATURES)
+    mean_all = row_sum / n_rows if n_rows else np.zeros(n_features)
+    mean_top = top_rows.mean(axis=0) if len(top_rows) else np.zeros(n_features)
+    return np.concatenate([mean_all, mean_top]).astype(np.float32)
+
+
+def playlist_embedding_from_scored(df_scored, k: int = EMBED_TOP_K) -> np.ndarray:
+    rows = embedding_rows(df_scored)
+    _, top_rows = _top_rows(df_scored["hit_score"].to_numpy(), rows, k)
+    return playlist_embedding(rows.sum(axis=0, dtype=np.float64), len(rows), top_rows)
+
+
+def record_playlist_embedding(playlist_ref, embedding, summary):
+    """Append one playlist vector (+ a little metadata) to the store."""
+    vec_path, meta_path = _embed_paths()
+    meta = {
+        "playlist_id": extract_playlist_id(playlist_ref),
+        "rated_at": time.time(),
+        "final_score_pct": float(summary["final_score_pct"]),
+        "label": summary["label"],
+    }
+    with _embed_lock:
+        os.makedirs(EMBED_DIR, exist_ok=True)
+        # both appends under one cross-process lock, so row i of the vectors
+        # always belongs to line i of the meta, whatever the other workers do
+        with _file_lock(os.path.join(EMBED_DIR, "append.lock")):
+            with open(vec_path, "ab") as f:
+                f.write(np.asarray(embedding, dtype=np.float32).tobytes())
+            with open(meta_path, "a") as f:
+                f.write(json.dumps(meta) + "\n")
+
+
+def load_playlist_embeddings():
+    """
+    Returns (vectors, meta, norms): a read-only float32 memmap
+    (n x EMBED_DIM), the row-aligned list of meta dicts and the row norms.
+    Meta and norms are cached and only new rows are read on later calls.
+    Rows without meta (a write cut short) are ignored.
+    """
+    vectors, meta, norms, _, _ = _load_embeddings()
+    return vectors, meta, norms
+
+
+def _load_embeddings():
+    """load_playlist_embeddings() + the per-row playlist codes and latest-rating mask."""
+    vec_path, meta_path = _embed_paths()
+    with _embed_lock:
+        if not os.path.exists(vec_path) or not os.path.exists(meta_path):
+            return (
+                np.empty((0, EMBED_DIM), dtype=np.float32), [], np.empty(0, dtype=np.float32),
+                np.empty(0, dtype=np.int32), np.empty(0, dtype=bool),
+            )
+
+        cache = _embed_cache
+        if cache["path"] != meta_path:
+            _reset_embed_cache(meta_path)
+        with open(meta_path) as f:
+            f.seek(cache["offset"])
+            for line in f:
+                if not line.endswith("\n"):
+                    break  # half-written line, pick it up next time
+                cache["offset"] += len(line.encode())
+                if line.strip():
+                    cache["meta"].append(json.loads(line))
+
+        n = min(os.path.getsize(vec_path) // (4 * EMBED_DIM), len(cache["meta"]))
+        if n == 0:
+            return (
+                np.empty((0, EMBED_DIM), dtype=np.float32), [], np.empty(0, dtype=np.float32),
+                np.empty(0, dtype=np.int32), np.empty(0, dtype=bool),
+            )
+        vectors = np.memmap(vec_path, dtype=np.float32, mode="r", shape=(n, EMBED_DIM))
+
+        n_known = len(cache["norms"])
+        if n > n_known:
+            cache["norms"] = np.concatenate(
+                [cache["norms"], np.linalg.norm(vectors[n_known:n], axis=1).astype(np.float32)]
+            )
+            codes = np.empty(n - n_known, dtype=np.int32)
+            latest = np.concatenate([cache["latest"], np.zeros(n - n_known, dtype=bool)])
+            latest_rows = cache["latest_rows"]
+            for row in range(n_known, n):
+                entry = cache["meta"][row]
+                code = cache["playlist_codes"].setdefault(entry["playlist_id"], len(latest_rows))
+                if code == len(latest_rows):
+                    latest_rows.append(row)
+                elif entry["rated_at"] >= cache["meta"][latest_rows[code]]["rated_at"]:
+                    latest[latest_rows[code]] = False
+                    latest_rows[code] = row
+                else:
+                    codes[row - n_known] = code
+                    continue
+                latest[row] = True
+                codes[row - n_known] = code
+            cache["codes"] = np.concatenate([cache["codes"], codes])
+            cache["latest"] = latest
+        return (
+            vectors, cache["meta"][:n], cache["norms"][:n],
+            cache["codes"][:n], cache["latest"][:n].copy(),
+        )
+
+
+def _unit_rows(vectors):
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return vectors / norms
+
+
+def build_embedding_index(n_clusters: int = 256, n_iter: int = 10, sample_size: int = 50_000, seed: int = 0):
+    """
+    Coarse k-means index over the stored (unit) vectors. Centroids are fit
+    on a sample, then every row is assigned to its closest centroid.
+    Rows appended later are still searched, just without pruning.
+    """
+    global _embed_index
+    vectors, _, _ = load_playlist_embeddings()
+    n = len(vectors)
+    if n == 0:
+        _embed_index = None
+        return None
+    n_clusters = min(n_clusters, n)
+    rng = np.random.default_rng(seed)
+
+    sample = _unit_rows(np.asarray(vectors[rng.choice(n, size=min(sample_size, n), replace=False)]))
+    centroids = sample[rng.choice(len(sample), size=n_clusters, replace=False)]
+    for _ in range(n_iter):
+        assign = np.argmax(sample @ centroids.T, axis=1)
+        for c in range(n_clusters):
+            members = sample[assign == c]
+            if len(members):
+                centroids[c] = members.mean(axis=0)
+        centroids = _unit_rows(centroids)
+
+    assign = np.empty(n, dtype=np.int32)
+    for start in range(0, n, EMBED_BLOCK_ROWS):
+        block = _unit_rows(np.asarray(vectors[start:start + EMBED_BLOCK_ROWS]))
+        assign[start:start + len(block)] = np.argmax(block @ centroids.T, axis=1)
+
+    order = np.argsort(assign, kind="stable")
+    bounds = np.searchsorted(assign[order], np.arange(n_clusters + 1))
+    _embed_index = {
+        "centroids": centroids.astype(np.float32),
+        "rows": order,                # row ids grouped by cluster
+        "bounds": bounds,             # cluster c -> rows[bounds[c]:bounds[c + 1]]
+        "n_indexed": n,
+    }
+    return _embed_index
+
+
+def nearest_playlists(embedding, k: int = 5, exclude=None, nprobe=None):
+    """
+    Stored playlists most similar (cosine) to `embedding`.
+      exclude: playlist url / id to leave out (e.g. the query playlist)
+      nprobe:  with an index built, only search rows in the nprobe closest
+               clusters (+ anything appended since); None = exact search
+    Returns a list of meta dicts (latest rating per playlist) with an added
+    "similarity", best first.
+    """
+    vectors, meta, norms, codes, latest = _load_embeddings()
+    if len(vectors) == 0:
+        return []
+    # only each playlist's latest rating is a candidate, never the excluded one
+    if exclude:
+        exclude_code = _embed_cache["playlist_codes"].get(extract_playlist_id(exclude))
+        if exclude_code is not None:
+            latest &= codes != exclude_code
+    query = _unit_rows(np.asarray(embedding, dtype=np.float32).reshape(1, -1))[0]
+
+    # which rows to score
+    index = _embed_index
+    if nprobe and index is not None and index["n_indexed"] <= len(vectors):
+        closest = np.argsort(-(index["centroids"] @ query))[:nprobe]
+        candidates = np.concatenate(
+            [index["rows"][index["bounds"][c]:index["bounds"][c + 1]] for c in closest]
+            + [np.arange(index["n_indexed"], len(vectors))]
+        )
+        candidates.sort()
+    else:
+        candidates = None
+
+    # cosine scores in blocks, masked rows can't make the top k
+    best_rows, best_sims = [], []
+    n_candidates = len(vectors) if candidates is None else len(candidates)
+    for start in range(0, n_candidates, EMBED_BLOCK_ROWS):
+        if candidates is None:
+            row_ids = np.arange(start, min(start + EMBED_BLOCK_ROWS, n_candidates))
+            block = np.asarray(vectors[start:start + EMBED_BLOCK_ROWS])
+        else:
+            row_ids = candidates[start:start + EMBED_BLOCK_ROWS]
+            block = np.asarray(vectors[row_ids])
+        block_norms = norms[row_ids]
+        sims = (block @ query) / np.where(block_norms == 0, 1, block_norms)
+        sims = np.where(latest[row_ids], sims, -np.inf)
+        if len(sims) > k:
+            top = np.argpartition(-sims, k)[:k]
+            row_ids, sims = row_ids[top], sims[top]
+        best_rows.append(row_ids)
+        best_sims.append(sims)
+
+    row_ids = np.concatenate(best_rows)
+    sims = np.concatenate(best_sims)
+
+    order = np.argsort(-sims, kind="stable")[:k]
+    return [
+        {**meta[i], "similarity": float(sim)}
+        for i, sim in zip(row_ids[order], sims[order])
+        if sim > -np.inf
+    ]
+
+
+# ----------------------------------------------------------
+# 11) RESULTS STORE
+# ----------------------------------------------------------
+# Every rating is kept on disk so trends can be analysed without going back
+# to the Spotify API:
+#   results_store/tracks/date=YYYY-MM-DD/model=<version>/<rating_id>.parquet
+#       one file per rating, one row group per scored frame (per chunk in
+#       chunked mode); compact_results_store() later merges a finished day's
+#       files into one per partition
+#   results_store/summaries/date=YYYY-MM-DD/model=<version>/<rating_id>.parquet
+#       one row per rating with the scalar summary fields (compacted the
+#       same way)
+# query_results() / query_summaries() read only the requested columns and
+# only the date / model partitions that match, via pyarrow's dataset API.
+
+RESULTS_DIR = "results_store"
+
+# columns every track file has; model features are stored next to them as float32
+TRACK_STORE_SCHEMA = pa.schema([
+    ("rating_id", pa.string()),
+    ("playlist_id", pa.string()),
+    ("rated_at", pa.float64()),
+    ("track_id", pa.string()),
+    ("track_name", pa.string()),
+    ("artist_id", pa.string()),
+    ("artist_name", pa.string()),
+    ("album_release_date", pa.string()),
+    ("hit_score", pa.float32()),
+    ("predicted_hit", pa.int8()),
+    ("degraded", pa.bool_()),          # scored with features the deadline cut off
+])
+
+# one row per rating
+SUMMARY_STORE_SCHEMA = pa.schema([
+    ("rating_id", pa.string()),
+    ("playlist_id", pa.string()),
+    ("rated_at", pa.float64()),
+    ("n_tracks", pa.int64()),
+    ("degraded", pa.bool_()),
+    ("mean_score", pa.float64()),
+    ("top_k_mean", pa.float64()),
+    ("playlist_index", pa.float64()),
+    ("final_score_pct", pa.float64()),
+    ("soft_threshold", pa.float64()),
+    ("soft_hit_rate", pa.float64()),
+    ("percentile", pa.float64()),
+    ("label", pa.string()),
+    ("reference_count", pa.int64()),
+])
+
+RESULTS_PARTITIONING = ds.partitioning(
+    pa.schema([("date", pa.string()), ("model", pa.string())]), flavor="hive"
+)
+
+def _results_dir(kind):
+    """"tracks" or "summaries"."""
+    return os.path.join(RESULTS_DIR, kind)
+
+
+def _partition_dir(kind, record):
+    return os.path.join(_results_dir(kind), f"date={record['date']}", f"model={record['model']}")
+
+
+def new_rating_record(playlist_ref, model) -> dict:
+    """Ids shared by everything one rating writes to the store."""
+    rated_at = time.time()
+    return {
+        "rating_id": uuid.uuid4().hex,
+        "playlist_id": extract_playlist_id(playlist_ref),
+        "rated_at": rated_at,
+        "date": datetime.fromtimestamp(rated_at, tz=timezone.utc).strftime("%Y-%m-%d"),
+        "model": model_version(model),
+        "writer": None,          # open ParquetWriter, see write_scored_tracks()
+    }
+
+
+def write_scored_tracks(df_scored, record, model_features):
+    """
+    Add one scored frame (or chunk) to this rating's parquet file, as a new
+    row group. The file stays hidden from readers until
+    finish_scored_tracks(). Failures are printed, never raised -- storing
+    must not break a rating.
+    """
+    if record.get("failed"):
+        return
+    try:
+        n = len(df_scored)
+        columns = {
+            "rating_id": [record["rating_id"]] * n,
+            "playlist_id": [record["playlist_id"]] * n,
+            "rated_at": np.full(n, record["rated_at"]),
+        }
+        for field in TRACK_STORE_SCHEMA:
+            if field.name in columns:
+                continue
+            if field.name not in df_scored.columns:
+                columns[field.name] = [None] * n
+            elif pa.types.is_string(field.type):
+                columns[field.name] = [None if pd.isna(v) else str(v) for v in df_scored[field.name]]
+            else:
+                columns[field.name] = df_scored[field.name].to_numpy()
+        table = pa.table(columns, schema=TRACK_STORE_SCHEMA)
+        for col in model_features:
+            if col in df_scored.columns and col not in TRACK_STORE_SCHEMA.names:
+                table = table.append_column(
+                    pa.field(col, pa.float32()),
+                    pa.array(pd.to_numeric(df_scored[col], errors="coerce").to_numpy(dtype=np.float32)),
+                )
+
+        if record["writer"] is None:
+            part_dir = _partition_dir("tracks", record)
+            os.makedirs(part_dir, exist_ok=True)
+            file_name = f"{record['rating_id']}.parquet"
+            record["path"] = os.path.join(part_dir, file_name)
+            record["tmp_path"] = os.path.join(part_dir, f".{file_name}.tmp")  # hidden from readers
+            record["writer"] = pq.ParquetWriter(record["tmp_path"], table.schema)
+        record["writer"].write_table(table)
+    except Exception as e:
+        print(f"⚠️ Could not store scored tracks: {e}")
+        finish_scored_tracks(record, keep=False)
+        record["failed"] = True
+
+
+def finish_scored_tracks(record, keep: bool = True):
+    """
+    Close this rating's parquet file and make it visible to readers
+    (keep=False: throw it away, e.g. when the rating failed half way).
+    """
+    writer = record.get("writer")
+    if writer is None:
+        return
+    record["writer"] = None
+    try:
+        writer.close()
+        if keep:
+            os.replace(record["tmp_path"], record["path"])
+        else:
+            os.remove(record["tmp_path"])
+    except Exception as e:
+        print(f"⚠️ Could not store scored tracks: {e}")
+
+
+def _partition_dirs(kind, before_date=None):
+    """(date, model) of every partition of one table in the store, oldest first."""
+    root = _results_dir(kind)
+    if not os.path.isdir(root):
+        return []
+    found = []
+    for date_dir in sorted(os.listdir(root)):
+        if not date_dir.startswith("date="):
+            continue
+        date = date_dir[len("date="):]
+        if before_date is not None and date >= before_date:
+            continue
+        for model_dir in sorted(os.listdir(os.path.join(root, date_dir))):
+            if model_dir.startswith("model="):
+                found.append((date, model_dir[len("model="):]))
+    return found
+
+
+def compact_results_partition(date: str, model: str, kind: str = "tracks") -> int:
+    """
+    Merge every file of one date / model partition of the "tracks" or
+    "summaries" table into a single parquet file (each input becomes one or
+    more row groups), one file in memory at a time. Returns how many files
+    were merged (0 = nothing to do).
+    Only run it on partitions that are no longer written to, from one
+    process at a time.
+    """
+    part_dir = _partition_dir(kind, {"date": date, "model": model})
+    if not os.path.isdir(part_dir):
+        return 0
+    paths = sorted(
+        os.path.join(part_dir, name) for name in os.listdir(part_dir)
+        if name.endswith(".parquet") and not name.startswith((".", "_"))
+    )
+    if len(paths) < 2:
+        return 0
+
+    # files of different models / versions can differ in columns
+    schema = pa.unify_schemas([pq.read_schema(path) for path in paths])
+    file_name = f"compacted-{uuid.uuid4().hex}.parquet"
+    tmp_path = os.path.join(part_dir, f".{file_name}.tmp")
+    try:
+        with pq.ParquetWriter(tmp_path, schema) as writer:
+            for path in paths:
+                table = pq.read_table(path)
+                for field in schema:
+                    if field.name not in table.column_names:
+                        table = table.append_column(field, pa.nulls(len(table), field.type))
+                writer.write_table(table.select(schema.names).cast(schema))
+        os.replace(tmp_path, os.path.join(part_dir, file_name))
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    for path in paths:
+        os.remove(path)
+    return len(paths)
+
+
+def compact_results_store(before_date=None) -> int:
+    """
+    compact_results_partition() for every partition dated before
+    before_date ("YYYY-MM-DD", default: today in UTC, which is still being
+    written to). Returns the number of files merged away.
+    """
+    if before_date is None:
+        before_date = datetime.now(timezone.utc).strftime("%Y-%m-%d")
+    merged = 0
+    for kind in ["tracks", "summaries"]:
+        for date, model in _partition_dirs(kind, before_date):
+            try:
+                merged += compact_results_partition(date, model, kind)
+            except Exception as e:
+                print(f"⚠️ Could not compact {kind} for {date} / {model}: {e}")
+    return merged
+
+
+def write_rating_summary(summary, record, n_tracks):
+    """Store this rating's row of the summary table (a small parquet file)."""
+    degraded = summary.get("degraded")
+    entry = {
+        "rating_id": record["rating_id"],
+        "playlist_id": record["playlist_id"],
+        "rated_at": record["rated_at"],
+        "n_tracks": int(n_tracks),
+        "degraded": bool(degraded and degraded["any"]),
+    }
+    for key in ["mean_score", "top_k_mean", "playlist_index", "final_score_pct",
+                "soft_threshold", "soft_hit_rate", "percentile"]:
+        value = summary.get(key)
+        entry[key] = None if value is None or pd.isna(value) else float(value)
+    entry["label"] = summary.get("label")
+    entry["reference_count"] = summary.get("reference_count")
+
+    try:
+        table = pa.Table.from_pylist([entry], schema=SUMMARY_STORE_SCHEMA)
+        part_dir = _partition_dir("summaries", record)
+        os.makedirs(part_dir, exist_ok=True)
+        file_name = f"{record['rating_id']}.parquet"
+        tmp_path = os.path.join(part_dir, f".{file_name}.tmp")  # hidden from readers
+        pq.write_table(table, tmp_path)
+        os.replace(tmp_path, os.path.join(part_dir, file_name))
+    except Exception as e:
+        print(f"⚠️ Could not store rating summary: {e}")
+
+
+def query_results(columns, start_date=None, end_date=None, model=None, filter=None) -> pd.DataFrame:
+    """
+    Read stored track rows.
+      columns:              columns to read (store columns, model features, "date", "model")
+      start_date/end_date:  "YYYY-MM-DD", inclusive -- only matching partitions are opened
+      model:                model version (see model_version()) to restrict to
+      filter:               extra pyarrow expression, e.g. ds.field("playlist_id") == "..."
+    """
+    # model features aren't in every file (models differ), so declare them
+    # up front; files without them read as null
+    extra = [
+        pa.field(c, pa.float32()) for c in columns
+        if c not in TRACK_STORE_SCHEMA.names and c not in ("date", "model")
+    ]
+    schema = pa.schema(list(TRACK_STORE_SCHEMA) + extra)
+    return _query_store("tracks", schema, columns, start_date, end_date, model, filter)
+
+
+def query_summaries(columns=None, start_date=None, end_date=None, model=None, filter=None) -> pd.DataFrame:
+    """
+    Read stored rating summaries (one row per rating); arguments as for
+    query_results(), columns=None reads them all.
+    """
+    if columns is None:
+        columns = SUMMARY_STORE_SCHEMA.names + ["date", "model"]
+    return _query_store("summaries", SUMMARY_STORE_SCHEMA, columns, start_date, end_date, model, filter)
+
+
+def _query_store(kind, schema, columns, start_date, end_date, model, filter):
+    if not os.path.isdir(_results_dir(kind)):
+        return pd.DataFrame(columns=list(columns))
+
+    schema = pa.schema(list(schema) + list(RESULTS_PARTITIONING.schema))
+    dataset = ds.dataset(
+        _results_dir(kind),
+        format="parquet",
+        partitioning=RESULTS_PARTITIONING,
+        schema=schema,
+        exclude_invalid_files=False,
+        ignore_prefixes=[".", "_"],
+    )
+
+    expr = None
+    for cond in [
+        ds.field("date") >= start_date if start_date else None,
+        ds.field("date") <= end_date if end_date else None,
+        ds.field("model") == model if model else None,
+        filter,
+    ]:
+        if cond is not None:
+            expr = cond if expr is None else expr & cond
+
+    return dataset.to_table(columns=list(columns), filter=expr).to_pandas()
+
+
+def load_rating_summaries() -> pd.DataFrame:
+    """Every stored rating summary as a DataFrame (one row per rating)."""
+    return query_summaries()
+
+
+def playlist_rating_history(playlist_ref) -> pd.DataFrame:
+    """How one playlist's rating changed: one row per rating, oldest first."""
+    cols = ["rated_at", "date", "model", "final_score_pct", "playlist_index", "label", "n_tracks"]
+    df = query_summaries(
+        cols, filter=ds.field("playlist_id") == extract_playlist_id(playlist_ref)
+    )
+    return df.sort_values("rated_at").reset_index(drop=True)
+
+
+def top_artists(n: int = 20, start_date=None, end_date=None, model=None) -> pd.DataFrame:
+    """
+    Artists that show up most across the stored playlists. Each playlist
+    counts once, with its latest rating in the date / model range (the hot
+    playlists are re-rated all the time); tracks scored with
+    deadline-defaulted features are left out.
+    Returns df with columns: artist_name, tracks, playlists, mean_hit_score.
+    """
+    ratings = query_summaries(
+        ["rating_id", "playlist_id", "rated_at"],
+        start_date=start_date, end_date=end_date, model=model,
+    )
+    latest = (
+        ratings.sort_values("rated_at", kind="stable")
+        .drop_duplicates("playlist_id", keep="last")["rating_id"]
+        .tolist()
+    )
+    df = query_results(
+        ["artist_id", "artist_name", "playlist_id", "hit_score"],
+        start_date=start_date, end_date=end_date, model=model,
+        filter=ds.field("rating_id").isin(latest) & ~ds.field("degraded"),
+    )
+    if df.empty:
+        return pd.DataFrame(columns=["artist_name", "tracks", "playlists", "mean_hit_score"])
+    return (
+        df.groupby("artist_id")
+        .agg(
+            artist_name=("artist_name", "first"),
+            tracks=("hit_score", "size"),
+            playlists=("playlist_id", "nunique"),
+            mean_hit_score=("hit_score", "mean"),
+        )
+        .sort_values(["playlists", "tracks"], ascending=False)
+        .head(n)
+        .reset_index(drop=True)
+    )
@@ -4,10 +4,20 @@ import html
 import time
 
 from playlist_backend import (
-    sp,                    # authenticated Spotify client
+    spotify_client,        # checks out a pooled Spotify client
     best_xgb_full,         # trained model
     best_threshold_full,   # F1-optimal threshold
-    rate_playlist          # the function
+    rate_playlist_cached,  # the function (+ short-lived rating cache)
+    start_warmup,          # once-per-worker warm-up
+    warmup_status,         # how far the warm-up got
+    HOT_PLAYLISTS,         # playlists to pre-rate at startup
+    RATING_DEADLINE,       # latency budget for a rating (seconds)
+    nearest_playlists,     # most similar previously rated playlists
+    results_table,         # display columns for the full results view
+    explain_tracks,        # per-track feature contributions (on demand)
+    top_contributions,     # biggest contributions for one track
+    pick_album_image,      # smallest cover size that fits a tile
+    get_thumbnail,         # locally cached cover bytes
 )
 
 st.set_page_config(page_title="Playlist Rater", page_icon="🎧", layout="wide")
@@ -285,8 +295,27 @@ st.caption("Paste a public Spotify playlist URL below to see how your taste stac
 
 # --- Input ---
 
+# cover tiles are a third of the ~900px content column
+COVER_TILE_PX = 300
+
 default_url = "https://open.spotify.com/playlist/0vurNqxrcDS4TYOpQvNxNA?si=pdUuGqKhRwiBfCrbv0unLg"
 
+@st.cache_resource(show_spinner=False)
+def warm_up_worker():
+    # runs once per worker process, in the background: token, model, then
+    # the hot playlists (the default one first)
+    return start_warmup([default_url] + HOT_PLAYLISTS)
+
+
+warm_up_worker()
+warmup = warmup_status()
+if not warmup["ready"]:
+    done = sum(state != "pending" for state in warmup["playlists"].values())
+    st.caption(
+        f"⏳ Warming up ({done}/{len(warmup['playlists'])} popular playlists ready) "
+        "— the first rating may take a little longer."
+    )
+
 playlist_url = st.text_input(
     "Spotify playlist URL:",
     value=default_url,
@@ -295,6 +324,68 @@ playlist_url = st.text_input(
 
 rate_button = st.button("Rate this playlist 🚀")
 
+# rows per page in the full results view
+RESULTS_PAGE_SIZE = 50
+
+
+def song_rows_html(df):
+    """<tr> rows for the cool-table (track / artist / year / hit score)."""
+    # no leading spaces, no Markdown code block
+    return "".join(
+        f"<tr>"
+        f"<td>{html.escape(str(track))}</td>"
+        f"<td>{html.escape(str(artist))}</td>"
+        f"<td>{html.escape(str(year))}</td>"
+        f"<td>{score:.3f}</td>"
+        f"</tr>"
+        for track, artist, year, score in zip(
+            df["track_name"], df["artist_name"], df["year"], df["hit_score"]
+        )
+    )
+
+
+def song_table_html(rows_html, title_html=""):
+    return (
+        "<div class='card'>"
+        f"{title_html}"
+        "<table class='cool-table'>"
+        "<thead>"
+        "<tr>"
+        "<th>Track</th>"
+        "<th>Artist</th>"
+        "<th>Year</th>"
+        "<th>Hit score</th>"
+        "</tr>"
+        "</thead>"
+        "<tbody>"
+        + rows_html +
+        "</tbody>"
+        "</table>"
+        "</div>"
+    )
+
+
+def render_song_table(df, title_emoji, title_text):
+    table_html = song_table_html(
+        song_rows_html(df), f"<h3>{title_emoji} {title_text}</h3>"
+    )
+    st.markdown(table_html, unsafe_allow_html=True)
+
+
+def results_page_html(rating, page):
+    """
+    HTML for one page of the full results table. Pages are built once per
+    rating and kept in the rating's page cache, so flipping back and forth
+    (or any other rerun) doesn't rebuild them.
+    """
+    pages = rating["pages"]
+    if page not in pages:
+        start = page * RESULTS_PAGE_SIZE
+        df_page = rating["results"].iloc[start:start + RESULTS_PAGE_SIZE]
+        pages[page] = song_table_html(song_rows_html(df_page))
+    return pages[page]
+
+
 # --- When user clicks ---
 
 if rate_button:
@@ -306,130 +397,253 @@ if rate_button:
                 # 1) Model feature names
                 model_features = list(best_xgb_full.get_booster().feature_names)
 
-                # 2) Call core function
-                summary, top5, bottom5, df_scored = rate_playlist(
-                    playlist_url=playlist_url,
-                    sp=sp,
-                    model=best_xgb_full,
-                    model_features=model_features,
-                    threshold=best_threshold_full,
-                    cache_buster=time.time(),
-                )
+                # 2) Call core function on a pooled client
+                with spotify_client() as sp:
+                    summary, top5, bottom5, df_scored = rate_playlist_cached(
+                        playlist_url=playlist_url,
+                        sp=sp,
+                        model=best_xgb_full,
+                        model_features=model_features,
+                        threshold=best_threshold_full,
+                        deadline=RATING_DEADLINE,
+                        cache_buster=time.time(),  # only used for non-hot playlists
+                    )
 
-                # --- Big final rating section ---
-                final_pct = summary.get("final_score_pct", 0.0)
-                label = summary.get("label", "")
+                # 3) Keep only what the page shows -- the wide scored frame
+                # is dropped here instead of living in the session
+                st.session_state["rating"] = {
+                    "id": f"{playlist_url}@{time.time()}",
+                    "summary": summary,
+                    "top5": top5,
+                    "bottom5": bottom5,
+                    "n_tracks": len(df_scored),
+                    "similar": nearest_playlists(
+                        summary["embedding"], k=5, exclude=playlist_url
+                    ),
+                    "results": results_table(df_scored),
+                    "pages": {},
+                    # feature matrix kept (float32) so explanations can be
+                    # computed later, only if someone asks for them
+                    "explain": (
+                        {
+                            "features": model_features,
+                            "X": df_scored[model_features].to_numpy(dtype="float32"),
+                            "track_ids": df_scored["track_id"].tolist(),
+                            # deadline-defaulted tracks, kept out of the explanation cache
+                            "no_cache": df_scored["degraded"].to_numpy(dtype=bool),
+                        }
+                        if set(model_features).issubset(df_scored.columns)
+                        else None
+                    ),
+                }
+                st.session_state["results_page"] = 1
+                for key in [k for k in st.session_state if str(k).startswith("explain_track")]:
+                    del st.session_state[key]
 
-                # Card container
-                # st.markdown("<div class='card'>", unsafe_allow_html=True)
+            except Exception as e:
+                st.session_state.pop("rating", None)
+                st.error(f"Something went wrong: {e}")
 
-                # Spotify-styled section header + rating
-                st.markdown(
-                    "<div class='section-title'>Playlist Rating</div>",
-                    unsafe_allow_html=True,
+# --- Results (re-rendered from the session on every rerun) ---
+
+rating = st.session_state.get("rating")
+
+if rating is not None:
+    summary = rating["summary"]
+    top5 = rating["top5"]
+    bottom5 = rating["bottom5"]
+
+    # --- Big final rating section ---
+    final_pct = summary.get("final_score_pct", 0.0)
+    label = summary.get("label", "")
+
+    # Card container
+    # st.markdown("<div class='card'>", unsafe_allow_html=True)
+
+    # Spotify-styled section header + rating
+    st.markdown(
+        "<div class='section-title'>Playlist Rating</div>",
+        unsafe_allow_html=True,
+    )
+
+    st.markdown(
+        f"<div class='rating-number'>{final_pct:.1f}%</div>",
+        unsafe_allow_html=True,
+    )
+
+    st.markdown(
+        f"<div class='rating-tagline'>{label}</div>",
+        unsafe_allow_html=True,
+    )
+
+    st.markdown(
+        f"<div class='rating-subtext'>Based on {rating['n_tracks']} tracks</div>",
+        unsafe_allow_html=True,
+    )
+
+    degraded = summary.get("degraded")
+    if degraded and degraded["any"]:
+        parts = []
+        if degraded["tracks"]:
+            parts.append(f"{len(degraded['tracks'])} tracks scored without full artist / audio data")
+        if degraded["truncated"]:
+            parts.append(f"about {degraded['tracks_skipped']} tracks not loaded")
+        st.caption("⏱️ Spotify was slow, so this is a quick rating: " + ", ".join(parts) + ".")
+
+    if summary.get("percentile") is not None:
+        st.markdown(
+            f"<div class='rating-subtext'>More mainstream than {summary['percentile']:.0f}% "
+            f"of the {summary['reference_count']:,} playlists rated so far</div>",
+            unsafe_allow_html=True,
+        )
+
+    # st.markdown("</div>", unsafe_allow_html=True)
+
+
+    # --- Top 3 covers strip (from top5) ---
+    top3 = top5.head(3)
+
+    # Only show if actually have image URLs
+    if "album_image_url" in top3.columns:
+        st.markdown(
+            "<h3 style='text-align:center; color:#f9fafb; margin-top:1.5rem;'>"
+            "🔥 Top 3 Tracks (Cover Preview)"
+            "</h3>",
+            unsafe_allow_html=True,
+        )
+
+        cols = st.columns(3)
+
+        for i, (_, row) in enumerate(top3.iterrows()):
+            with cols[i]:
+                img_url = (
+                    pick_album_image(row.get("album_images"), COVER_TILE_PX)
+                    or row["album_image_url"]
                 )
-
+                if img_url:
+                    st.image(get_thumbnail(img_url) or img_url, use_container_width=True)
                 st.markdown(
-                    f"<div class='rating-number'>{final_pct:.1f}%</div>",
+                    f"""
+                    <div style='text-align:center; color:#f1f5f9; font-size:0.9rem; margin-top:0.5rem;'>
+                        <strong>{html.escape(str(row['track_name']))}</strong><br>
+                        <span style='color:#cbd5e1;'>{html.escape(str(row['artist_name']))}</span>
+                    </div>
+                    """,
                     unsafe_allow_html=True,
                 )
 
-                st.markdown(
-                    f"<div class='rating-tagline'>{label}</div>",
-                    unsafe_allow_html=True,
-                )
-
-                st.markdown(
-                    f"<div class='rating-subtext'>Based on {len(df_scored)} tracks</div>",
-                    unsafe_allow_html=True,
-                )
-
-                # st.markdown("</div>", unsafe_allow_html=True)
-
-
-                # --- Top 3 covers strip (from top5) ---
-                top3 = top5.head(3)
-
-                # Only show if actually have image URLs
-                if "album_image_url" in top3.columns:
-                    st.markdown(
-                        "<h3 style='text-align:center; color:#f9fafb; margin-top:1.5rem;'>"
-                        "🔥 Top 3 Tracks (Cover Preview)"
-                        "</h3>",
-                        unsafe_allow_html=True,
-                    )
-
-                    cols = st.columns(3)
-
-                    for i, (_, row) in enumerate(top3.iterrows()):
-                        with cols[i]:
-                            img_url = row["album_image_url"]
-                            if img_url:
-                                st.image(img_url, use_container_width=True)
-                            st.markdown(
-                                f"""
-                                <div style='text-align:center; color:#f1f5f9; font-size:0.9rem; margin-top:0.5rem;'>
-                                    <strong>{html.escape(str(row['track_name']))}</strong><br>
-                                    <span style='color:#cbd5e1;'>{html.escape(str(row['artist_name']))}</span>
-                                </div>
-                                """,
-                                unsafe_allow_html=True,
-                            )
-
-
-
-                # --- Top 5 section ---
-                def render_song_table(df, title_emoji, title_text):
-                    rows = []
-                    for _, row in df.iterrows():
-                        track = html.escape(str(row["track_name"]))
-                        artist = html.escape(str(row["artist_name"]))
-                        year = html.escape(str(row["year"]))
-                        score = f"{row['hit_score']:.3f}"
-
-                        # no leading spaces, no Markdown code block
-                        rows.append(
-                            f"<tr>"
-                            f"<td>{track}</td>"
-                            f"<td>{artist}</td>"
-                            f"<td>{year}</td>"
-                            f"<td>{score}</td>"
-                            f"</tr>"
-                        )
-
-                    table_html = (
-                        "<div class='card'>"
-                        f"<h3>{title_emoji} {title_text}</h3>"
-                        "<table class='cool-table'>"
-                        "<thead>"
-                        "<tr>"
-                        "<th>Track</th>"
-                        "<th>Artist</th>"
-                        "<th>Year</th>"
-                        "<th>Hit score</th>"
-                        "</tr>"
-                        "</thead>"
-                        "<tbody>"
-                        + "".join(rows) +
-                        "</tbody>"
-                        "</table>"
-                        "</div>"
-                    )
-
-                    st.markdown(table_html, unsafe_allow_html=True)
 
 
+    # --- Top 5 section ---
+    render_song_table(top5, "🔥", "Top 5 most 'hit-like' tracks")
+
+    # --- Bottom 5 section ---
+    render_song_table(bottom5, "🧊", "Bottom 5 least 'hit-like' tracks")
+
+
+    # --- Playlists most like this one ---
+    if rating["similar"]:
+        st.markdown(
+            "<div class='subsection-title'>🧭 Playlists most like yours</div>",
+            unsafe_allow_html=True,
+        )
+        rows_html = "".join(
+            f"<tr>"
+            f"<td><a href='https://open.spotify.com/playlist/{html.escape(p['playlist_id'])}' "
+            f"target='_blank'>{html.escape(p['playlist_id'])}</a></td>"
+            f"<td>{p['final_score_pct']:.1f}%</td>"
+            f"<td>{p['similarity']:.3f}</td>"
+            f"</tr>"
+            for p in rating["similar"]
+        )
+        st.markdown(
+            "<div class='card'>"
+            "<table class='cool-table'>"
+            "<thead><tr><th>Playlist</th><th>Rating</th><th>Similarity</th></tr></thead>"
+            "<tbody>" + rows_html + "</tbody>"
+            "</table>"
+            "</div>",
+            unsafe_allow_html=True,
+        )
+
+
+    # Optional: expandable full table, one page at a time
+    with st.expander("See full scored playlist"):
+        results = rating["results"]
+        if {"track_name", "artist_name", "year"}.issubset(results.columns):
+            n_pages = max(1, -(-len(results) // RESULTS_PAGE_SIZE))
+            page = st.number_input(
+                f"Page (of {n_pages})",
+                min_value=1,
+                max_value=n_pages,
+                step=1,
+                key="results_page",
+            )
+            st.markdown(results_page_html(rating, int(page) - 1), unsafe_allow_html=True)
+        else:
+            # chunked ratings only keep the scores
+            st.caption("Per-track details aren't kept for this playlist (scored in chunks).")
+
+
+    # --- Why did a track score like that? (computed only when asked) ---
+    explain = rating["explain"]
+    if explain is not None and len(rating["results"]):
+        st.markdown(
+            "<div class='subsection-title'>🔍 Why did a track score like that?</div>",
+            unsafe_allow_html=True,
+        )
+
+        if st.toggle("Explain track scores", key="show_explanations"):
+            # one batch for the whole playlist, first time only
+            if "contribs" not in explain:
+                explain["contribs"] = explain_tracks(
+                    best_xgb_full, explain["X"], explain["track_ids"],
+                    no_cache=explain["no_cache"],
+                )
 
-                # --- Top 5 section ---
-                render_song_table(top5, "🔥", "Top 5 most 'hit-like' tracks")
-
-                # --- Bottom 5 section ---
-                render_song_table(bottom5, "🧊", "Bottom 5 least 'hit-like' tracks")
-
-
-                # Optional: expandable full table
-                with st.expander("See full scored playlist"):
-                    st.dataframe(df_scored)
-
-            except Exception as e:
-                st.error(f"Something went wrong: {e}")
+            # only the tracks on the current results page go to the browser,
+            # so the payload stays one page long however big the playlist is
+            page = int(st.session_state.get("results_page", 1)) - 1
+            start = page * RESULTS_PAGE_SIZE
+            df_page = rating["results"].iloc[start:start + RESULTS_PAGE_SIZE]
+            labels = {
+                j: f"{track} — {artist} ({score:.3f})"
+                for j, track, artist, score in zip(
+                    df_page.index, df_page["track_name"], df_page["artist_name"], df_page["hit_score"]
+                )
+            }
+            # highest scores first
+            options = list(
+                df_page["hit_score"].sort_values(ascending=False, kind="stable").index
+            )
+            i = st.selectbox(
+                "Track (from the current page of the full results)",
+                options,
+                format_func=labels.get,
+                key=f"explain_track_{page}",
+            )
+
+            df_why = top_contributions(
+                explain["contribs"].iloc[i],
+                pd.Series(explain["X"][i], index=explain["features"]),
+            )
+            rows_html = "".join(
+                f"<tr>"
+                f"<td>{html.escape(str(feature))}</td>"
+                f"<td>{value:.3g}</td>"
+                f"<td>{contribution:+.3f}</td>"
+                f"</tr>"
+                for feature, value, contribution in zip(
+                    df_why["feature"], df_why["value"], df_why["contribution"]
+                )
+            )
+            st.markdown(
+                "<div class='card'>"
+                "<table class='cool-table'>"
+                "<thead><tr><th>Feature</th><th>Value</th><th>Push on score</th></tr></thead>"
+                "<tbody>" + rows_html + "</tbody>"
+                "</table>"
+                "</div>",
+                unsafe_allow_html=True,
+            )
+            st.caption("Positive values pushed the track towards 'hit', negative away from it (log-odds).")